@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+
+# Microbenchmarks for ppfun2
+# Distributed under WTFPL
+#
+# python ppbench.py                        runs everything and compares with the last saved version
+# python ppbench.py --sizes 64 512         only on the smaller images
+#
+# Everything runs offline, on synthetic images, chunks and pixel updates.
+# The results are saved to ppbench.json by the bot version, so that a slowdown shows up
+#  when the next version is benchmarked.
+
+import time, random, datetime, json, argparse, asyncio, io, contextlib
+import os.path as path
+import numpy as np
+import ppfun2
+
+# the synthetic canvas: as big as the main PixelPlanet canvas, with a 32 color palette
+CANVAS_SIZE = 65536
+PALETTE = [[202, 227, 255], [255, 255, 255]] + \
+          [[r, g, b] for r in (0, 85, 170, 255) for g in (0, 128, 255) for b in (0, 255)]
+# sides of the images
+SIZES = [64, 512, 2048]
+# the biggest batch of pixel updates and placement packets
+MAX_PACKETS = 65536
+# Floyd-Steinberg dithering takes too long on bigger images
+MAX_DITHER_SIZE = 512
+RESULTS_FILE = 'ppbench.json'
+
+# the byte-by-byte packet code ppfun2 used before the struct-based codec, for comparison
+def legacy_place_packet(d, x, y, c):
+    csz = ppfun2.me['canvases'][str(d)]['size']
+    modOffs = (csz // 2) % 256
+    offs = (((y + modOffs) % 256) * 256) + ((x + modOffs) % 256)
+    i = (x + csz // 2) // 256
+    j = (y + csz // 2) // 256
+    data = bytearray(7)
+    data[0] = 0xC1
+    data[1] = i
+    data[2] = j
+    data[3] = (offs >> 16) & 0xFF
+    data[4] = (offs >>  8) & 0xFF
+    data[5] = (offs >>  0) & 0xFF
+    data[6] = c
+    return data
+
+def legacy_pixel_update(d, data):
+    csz = ppfun2.me['canvases'][str(d)]['size']
+    i = data[1]
+    j = data[2]
+    offs = (data[3] << 16) | (data[4] << 8) | data[5]
+    clr = data[6]
+    x = ((i * 256) - (csz // 2)) + (offs & 0xFF)
+    y = ((j * 256) - (csz // 2)) + ((offs >> 8) & 0xFF)
+    return x, y, clr
+
+# a stand-in for the WebSocket that keeps the last packet
+class Sink:
+    def send_binary(self, data):
+        self.data = data
+
+# serves chunks from memory instead of the server
+class MemoryLoader(ppfun2.ChunkLoader):
+    def __init__(self, chunks):
+        super().__init__(cache_dir=None)
+        self.chunks = chunks
+
+    def fetch(self, d, x, y):
+        return self.chunks[x, y]
+
+# name -> result of the benchmarks that have run
+results = {}
+# minimum time every benchmark runs for, in seconds
+min_time = 0.5
+
+# runs fn over and over for at least min_time seconds, returns calls per second
+def rate(fn):
+    n, start = 0, time.perf_counter()
+    while True:
+        fn()
+        n += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return n / elapsed
+
+def report(name, per_sec, unit='packets'):
+    results[name] = per_sec
+    print(f'{name:<52} {per_sec:>14,.0f} {unit}/s')
+
+# a BGRA image with smooth gradients, some noise and transparent corners
+def synthetic_image(size, rng):
+    ys, xs = np.mgrid[:size, :size] / size
+    bgr = np.stack((xs * 255, ys * 255, (xs + ys) * 127), axis=2) + rng.normal(0, 12, (size, size, 3))
+    img = np.empty((size, size, 4), np.uint8)
+    img[:, :, :3] = np.clip(bgr, 0, 255)
+    img[:, :, 3] = np.where((xs - 0.5) ** 2 + (ys - 0.5) ** 2 < 0.3, 255, 0)
+    return img
+
+# raw chunks of random colors, some of them protected
+def synthetic_chunks(coords, rng):
+    return {c: (rng.integers(0, len(PALETTE), 65536) | (rng.random(65536) < 0.05) * 128).astype(np.uint8).tobytes()
+            for c in coords}
+
+# chunks (i, j) an image of some size at (x, y) covers
+def covered_chunks(x, y, size):
+    half = CANVAS_SIZE // 2
+    return [(i, j) for j in range((y + half) >> 8, ((y + half + size - 1) >> 8) + 1)
+                   for i in range((x + half) >> 8, ((x + half + size - 1) >> 8) + 1)]
+
+def bench_codec(count=10000):
+    rng = np.random.default_rng(0)
+    xs = rng.integers(-CANVAS_SIZE // 2, CANVAS_SIZE // 2, count)
+    ys = rng.integers(-CANVAS_SIZE // 2, CANVAS_SIZE // 2, count)
+    cs = rng.integers(2, 32, count)
+    coords = list(zip(xs.tolist(), ys.tolist(), cs.tolist()))
+    packets = ppfun2.encode_pixels(0, xs, ys, cs)
+
+    # make sure both implementations agree before timing them
+    sink = Sink()
+    for x, y, c in random.Random(0).sample(coords, 1000):
+        ppfun2.place_pixel(sink, 0, x, y, c)
+        assert bytes(sink.data) == bytes(legacy_place_packet(0, x, y, c))
+        packet = ppfun2.decode_packet(bytes(sink.data))
+        assert ppfun2.canvas_geometry(0).from_packet(packet.i, packet.j, packet.offs) + (packet.clr,) == (x, y, c)
+
+    print('Packet codec')
+    report('place_pixel(), legacy', rate(lambda: [legacy_place_packet(0, x, y, c) for x, y, c in coords]) * count)
+    report('place_pixel()', rate(lambda: [ppfun2.place_pixel(sink, 0, x, y, c) for x, y, c in coords]) * count)
+    report('encode_pixels(), batched', rate(lambda: ppfun2.encode_pixels(0, xs, ys, cs)) * count)
+    report('pixel update decoding, legacy', rate(lambda: [legacy_pixel_update(0, p) for p in packets]) * count)
+    geometry = ppfun2.canvas_geometry(0)
+    def decode(p):
+        packet = ppfun2.decode_packet(p)
+        return geometry.from_packet(packet.i, packet.j, packet.offs) + (packet.clr,)
+    report('decode_packet()', rate(lambda: [decode(p) for p in packets]) * count)
+    report('decode_pixel_updates(), batched', rate(lambda: ppfun2.decode_pixel_updates(packets)) * count)
+
+# image conversion in main()
+def bench_quantize(size):
+    img = synthetic_image(size, np.random.default_rng(size))
+    modes = [('rgb', 'none'), ('lab', 'none'), ('rgb', 'ordered')]
+    if size <= MAX_DITHER_SIZE:
+        modes.append(('rgb', 'floyd-steinberg'))
+    for metric, dither in modes:
+        report(f'quantize_image(), {metric}, {dither}, {size}²',
+               rate(lambda: ppfun2.quantize_image(img, PALETTE, metric, dither)) * size * size, 'pixels')
+
+# chunk decoding and assembly, and previews
+def bench_chunks(size):
+    rng = np.random.default_rng(size)
+    coords = covered_chunks(0, 0, size)
+    ppfun2.chunk_loader = MemoryLoader(synthetic_chunks(coords, rng))
+    chunk_pixels = len(coords) * 65536
+
+    report(f'get_chunk(), {size}²', rate(lambda: [ppfun2.get_chunk(0, i, j) for i, j in coords]) * chunk_pixels, 'pixels')
+    report(f'ChunkStore.load(), {size}²', rate(lambda: ppfun2.ChunkStore(0).load(coords)) * chunk_pixels, 'pixels')
+    store = ppfun2.ChunkStore(0)
+    store.load(coords)
+    bounds = store.bounds()
+    report(f'ChunkStore.region(), {size}²', rate(lambda: store.region(*bounds)) * chunk_pixels, 'pixels')
+    data = store.region(*bounds)
+    template = ppfun2.quantize_image(synthetic_image(size, rng), PALETTE)
+    report(f'render_map(), {size}²', rate(lambda: ppfun2.render_map(0, data)) * data.size, 'pixels')
+    report(f'render_map() with the template, {size}²',
+           rate(lambda: ppfun2.render_map(0, data, 1, template)) * data.size, 'pixels')
+
+# a job drawing a synthetic image over random chunks, across chunk borders
+def synthetic_job(size, rng, defend=False):
+    x, y = -size // 2 - 100, -size // 2 - 100
+    coords = covered_chunks(x, y, size)
+    ppfun2.chunk_loader = MemoryLoader(synthetic_chunks(coords, rng))
+    store = ppfun2.ChunkStore(0)
+    store.load(coords)
+    img = ppfun2.quantize_image(synthetic_image(size, rng), PALETTE)
+    return ppfun2.Job(store, img, x, y, defend, 'forward')
+
+# finding what's wrong and planning the placements in draw_function()
+def bench_plan(size):
+    rng = np.random.default_rng(size)
+    job = synthetic_job(size, rng, defend=True)
+    manager = ppfun2.JobManager([job])
+
+    report(f'Job.mismatch(), {size}²', rate(job.mismatch) * size * size, 'pixels')
+    for strategy in ['forward', 'spiral', 'edges']:
+        job.strategy = strategy
+        report(f'JobManager.plan(), {strategy}, {size}²', rate(manager.plan) * size * size, 'pixels')
+    report(f'JobManager.wrong_pixels(), {size}²', rate(lambda: manager.wrong_pixels([job])) * size * size, 'pixels')
+    wrong = manager.wrong_pixels([job])
+    count = sum(len(xs) for _, xs, _ in wrong)
+    report(f'RepairQueue.push(), {size}²', rate(lambda: ppfun2.RepairQueue(manager).push(wrong)) * count, 'pixels')
+    # (refilled when it runs out on the small images)
+    queue = ppfun2.RepairQueue(manager)
+    queue.push(wrong)
+    def take():
+        if not len(queue):
+            queue.push(wrong)
+        next(queue)
+    report(f'RepairQueue, taking pixels, {size}²', rate(take), 'pixels')
+
+# writing batches of pixel updates into the chunks in apply_updates()
+def bench_updates(size):
+    rng = np.random.default_rng(size)
+    job = synthetic_job(size, rng, defend=True)
+    manager = ppfun2.JobManager([job])
+    count = min(size * size, MAX_PACKETS)
+    xs = rng.integers(0, size, count) + job.draw_x
+    ys = rng.integers(0, size, count) + job.draw_y
+    packets = ppfun2.encode_pixels(0, xs, ys, rng.integers(2, len(PALETTE), count))
+    # a pixel that changes several times in a batch is only applied (or dropped) once
+    distinct = len(np.unique(ys * CANVAS_SIZE + xs))
+    ppfun2.dirty_pixels = ppfun2.DirtySet()
+
+    report(f'decode_pixel_updates(), {size}²', rate(lambda: ppfun2.decode_pixel_updates(packets)) * count)
+
+    # puts a batch into the queue and waits for apply_updates() to be done with it
+    async def run():
+        updates = ppfun2.UpdateQueue()
+        task = asyncio.create_task(ppfun2.apply_updates(updates, manager))
+        n, start = 0, time.perf_counter()
+        while True:
+            done = updates.applied + updates.dropped + distinct
+            for packet in packets:
+                updates.put(0, packet)
+            while updates.applied + updates.dropped < done:
+                await asyncio.sleep(0)
+            n += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                task.cancel()
+                return n / elapsed
+    with contextlib.redirect_stdout(io.StringIO()):
+        per_sec = asyncio.run(run()) * count
+    report(f'apply_updates(), {size}²', per_sec)
+    report(f'place_pixel(), {size}²',
+           rate(lambda: [ppfun2.place_pixel(Sink(), 0, x, y, 2) for x, y in zip(xs.tolist(), ys.tolist())]) * count)
+
+# saved results, {version: {'date': ..., 'results': {name: per second}}}
+def load_results(file):
+    if not path.exists(file):
+        return {}
+    with open(file) as f:
+        return json.load(f)
+
+# prints how the results changed since a baseline, the ones slower by more than threshold are marked
+def compare(baseline, version, threshold):
+    print(f'\nCompared with version {version}')
+    slower = 0
+    for name, per_sec in results.items():
+        old = baseline.get(name)
+        if not old:
+            continue
+        ratio = per_sec / old
+        mark = ''
+        if ratio < 1 - threshold:
+            mark = '  slower'
+            slower += 1
+        print(f'{name:<52} {ratio:>8.2f}x{mark}')
+    print(f'{slower} benchmark(s) got slower by more than {threshold * 100:.0f}%')
+
+def main():
+    global min_time
+    parser = argparse.ArgumentParser(description='Offline microbenchmarks for ppfun2')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='sides of the synthetic images')
+    parser.add_argument('--min-time', type=float, default=min_time, help='seconds to run every benchmark for')
+    parser.add_argument('--results', default=RESULTS_FILE, help='file to keep the results of every version in')
+    parser.add_argument('--baseline', help='version to compare with (the last one saved before this one by default)')
+    parser.add_argument('--threshold', type=float, default=0.1, help='slowdown to point out, 0.1 is 10%%')
+    parser.add_argument('--no-save', dest='save', action='store_false', help='don\'t save the results')
+    args = parser.parse_args()
+    min_time = args.min_time
+
+    ppfun2.me = {'canvases': {'0': {'size': CANVAS_SIZE, 'colors': PALETTE}}}
+    bench_codec()
+    for size in args.sizes:
+        print(f'\n{size}x{size}')
+        bench_quantize(size)
+        bench_chunks(size)
+        bench_plan(size)
+        bench_updates(size)
+
+    version = str(ppfun2.VERSION_NUM)
+    saved = load_results(args.results)
+    baseline = args.baseline
+    if baseline is None:
+        older = sorted((int(v) for v in saved if int(v) < int(version)), reverse=True)
+        baseline = str(older[0]) if older else version
+    if baseline in saved:
+        compare(saved[baseline]['results'], baseline, args.threshold)
+    if args.save:
+        # keep the results of the benchmarks that didn't run this time
+        kept = saved.get(version, {}).get('results', {})
+        saved[version] = {'date': datetime.datetime.now().isoformat(timespec='seconds'), 'results': {**kept, **results}}
+        with open(args.results, 'w') as f:
+            json.dump(saved, f, indent=1)
+        print(f'\nResults saved to {args.results} as version {version}')
+
+if __name__ == "__main__":
+    main()
@@ -5,26 +5,24 @@
 
 not_inst_libs = []
 
-import threading
-import requests, json
-import time, datetime, math, random
-import os.path as path, getpass
+import threading, concurrent.futures, asyncio, collections, functools, heapq
+import requests, json, hashlib, struct
+import time, datetime, math
+import os, os.path as path, getpass, argparse, importlib.util
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-try:
-    from playsound import playsound
-except ImportError:
-    not_inst_libs.append('playsound')
+# these are slow to import, so they're only imported when needed
+#  (cv2 for loading and showing images, playsound for the CAPTCHA notification)
+for module, package in [('playsound', 'playsound'), ('cv2', 'opencv-python')]:
+    if importlib.util.find_spec(module) is None:
+        not_inst_libs.append(package)
 
 try:
     import numpy as np
 except ImportError:
     not_inst_libs.append('numpy')
 
-try:
-    import cv2
-except ImportError:
-    not_inst_libs.append('opencv-python')
-
 try:
     import websocket
 except ImportError:
@@ -50,495 +48,2318 @@ VERSION_NUM = 5
 BOT_URL    = 'https://raw.githubusercontent.com/portasynthinca3/ppfun2/master/ppfun2.py'
 VERDEF_URL = 'https://raw.githubusercontent.com/portasynthinca3/ppfun2/master/verdef'
 
-# are we allowed to draw
-draw = True
-# was the last placing of the pixel successful
-succ = False
+# the PixelPlanet server
+PPFUN_URL    = 'https://pixelplanet.fun'
+PPFUN_WS_URL = 'wss://pixelplanet.fun:443/ws'
+# where downloaded data is cached between runs
+CACHE_DIR = 'ppfun2_cache'
 
-# chunk data cache
-chunk_data = None
+# template pixels that were changed by someone else
+dirty_pixels = None
+# how often defend mode rechecks the whole image, in seconds
+DEFEND_SWEEP_INTERVAL = 30
+# the order defend mode repairs pixels in: 'priority' (most important first) or 'raster' (row by row)
+DEFEND_ORDER = 'priority'
+# how much the parts of a pixel's repair priority weigh
+DEFEND_WEIGHTS = {'importance': 1.0, 'recency': 1.0, 'heat': 1.0}
+# how fast the damage a pixel has taken is forgotten, in seconds
+HEAT_HALF_LIFE = 300
+# how fast damage stops being recent, in seconds
+RECENCY_TIME = 30
 
 # number of pixels drawn and the starting time
 pixels_drawn = 1
 start_time = None
 
+# the biggest image shown in a window without downsampling
+PREVIEW_MAX_W = 1600
+PREVIEW_MAX_H = 900
+# how much of the canvas around the image is shown with it, in pixels
+AREA_MARGIN = 128
+
+# log levels
+DEBUG, INFO, WARNING, ERROR = range(4)
+LOG_LEVELS = ['debug', 'info', 'warning', 'error']
+
+# messages that come too often to print every one of them:
+#  event -> (interval in seconds, what to call them in the summary)
+LOG_LIMITS = {
+    'place':        (5,  'pixel placements'),
+    'defend':       (5,  'pixel repairs'),
+    'pixel_return': (10, 'pixel returns'),
+    'cooldown':     (10, 'cooldown waits'),
+    'retry':        (10, 'failed placements'),
+    'skip':         (10, 'skipped pixels'),
+    'updates':      (10, 'pixel updates'),
+    'lag':          (10, 'lag warnings'),
+    'online':       (60, 'online counter updates'),
+    'unknown':      (10, 'unknown packets'),
+}
+
+# prints log messages
+# only the first message of a rate-limited event is printed in each interval,
+#  the rest are counted and summed up once the interval is over
+#  ("1,240 pixel updates in last 10 s")
+class Logger:
+    def __init__(self, level=INFO, limits=LOG_LIMITS):
+        self.level = level
+        self.limits = limits
+        self.lock = threading.Lock()
+        # event -> [interval start, level, count, suppressed messages]
+        self.windows = {}
+
+    # count is how many things the message is about (e.g. pixel updates in a batch)
+    def log(self, text, level=INFO, event=None, count=1):
+        if level < self.level:
+            return
+        if event in self.limits:
+            now = time.monotonic()
+            with self.lock:
+                summaries = self._expire(now)
+                window = self.windows.get(event)
+                if window is None:
+                    self.windows[event] = [now, level, count, 0]
+                else:
+                    window[2] += count
+                    window[3] += 1
+            for summary in summaries:
+                print(summary)
+            if window is not None:
+                return
+        print(text)
+
+    # prints the summaries of the intervals that are over
+    def flush(self):
+        with self.lock:
+            summaries = self._expire(time.monotonic())
+        for summary in summaries:
+            print(summary)
+
+    def _expire(self, now):
+        summaries = []
+        for event, (start, level, count, suppressed) in list(self.windows.items()):
+            interval, noun = self.limits[event]
+            if now - start < interval:
+                continue
+            del self.windows[event]
+            if suppressed and level >= self.level:
+                summaries.append(f'{Fore.GREEN}{count:,}{Fore.YELLOW} {noun} in last {interval} s{Style.RESET_ALL}')
+        return summaries
+
+logger = Logger()
+
+# counters, gauges and histograms, exported in the Prometheus text format
+class Metrics:
+    # histogram buckets, in seconds
+    BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # name -> (type, help)
+        self.kinds = {}
+        # name -> {labels: value}, histograms keep [bucket counts, sum, count]
+        self.values = {}
+
+    def describe(self, name, kind, help):
+        self.kinds[name] = (kind, help)
+        self.values[name] = {}
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            values = self.values[name]
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[name][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            hist = self.values[name].setdefault(key, [[0] * len(self.BUCKETS), 0, 0])
+            for n, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    hist[0][n] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    def render(self):
+        def fmt(labels):
+            return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}' if labels else ''
+        lines = []
+        with self.lock:
+            for name, (kind, help) in self.kinds.items():
+                lines += [f'# HELP {name} {help}', f'# TYPE {name} {kind}']
+                for labels, value in self.values[name].items():
+                    if kind != 'histogram':
+                        lines.append(f'{name}{fmt(labels)} {value}')
+                        continue
+                    buckets, total, count = value
+                    for bound, n in zip(self.BUCKETS, buckets):
+                        lines.append(f'{name}_bucket{fmt(labels + (("le", bound),))} {n}')
+                    lines.append(f'{name}_bucket{fmt(labels + (("le", "+Inf"),))} {count}')
+                    lines.append(f'{name}_sum{fmt(labels)} {total}')
+                    lines.append(f'{name}_count{fmt(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+metrics.describe('ppfun2_placements_total', 'counter', 'Pixel placements by server return code ("timeout" if there was no answer)')
+metrics.describe('ppfun2_placement_rtt_seconds', 'histogram', 'Time from sending a pixel to getting the pixel return')
+metrics.describe('ppfun2_cooldown_wait_seconds', 'histogram', 'Time spent waiting for the cooldown before placing')
+metrics.describe('ppfun2_pixel_updates_total', 'counter', 'Pixel updates received from the server')
+metrics.describe('ppfun2_griefed_pixels_total', 'counter', 'Pixel updates that made a template pixel wrong')
+metrics.describe('ppfun2_update_queue_depth', 'gauge', 'Pixel updates waiting to be applied')
+metrics.describe('ppfun2_update_queue_lag_seconds', 'gauge', 'How long the oldest queued pixel update has been waiting')
+metrics.describe('ppfun2_wrong_pixels', 'gauge', 'Template pixels that differ from the canvas')
+metrics.describe('ppfun2_sessions', 'gauge', 'Connected sessions')
+metrics.describe('ppfun2_repair_queue_depth', 'gauge', 'Pixels waiting to be repaired in defend mode')
+
+# how often the metrics file is rewritten, in seconds
+METRICS_INTERVAL = 10
+
+# writes a file so that readers never see it half-written, and stopping the bot
+#  in the middle never leaves half of one
+# data is bytes, or a function that writes into the open file
+def write_file(file, data):
+    if path.dirname(file):
+        os.makedirs(path.dirname(file), exist_ok=True)
+    tmp = f'{file}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp, 'wb') as f:
+        if callable(data):
+            data(f)
+        else:
+            f.write(data)
+    os.replace(tmp, file)
+
 # play a notification sound
 def play_notification():
+    from playsound import playsound
     playsound('notif.mp3')
 
 # shows the image in a window
+# images bigger than the window are downsampled first
 def show_image(img):
+    import cv2
     print(f'{Fore.YELLOW}Scroll to zoom, drag to pan, press any key to close the window{Style.RESET_ALL}')
-    cv2.imshow('image', img)
+    step = preview_step(img.shape)
+    if step > 1:
+        print(f'{Fore.YELLOW}The image is too big, showing every {Fore.GREEN}{step}{Fore.YELLOW}th pixel{Style.RESET_ALL}')
+    cv2.imshow('image', img[::step, ::step])
     cv2.waitKey(0)
     cv2.destroyAllWindows()
 
+# color spaces the image can be matched to the palette in
+COLOR_METRICS = ['rgb', 'lab']
+# dithering modes
+DITHER_MODES = ['none', 'ordered', 'floyd-steinberg']
+
+# 8x8 Bayer threshold matrix for ordered dithering, normalized to [-0.5, 0.5)
+BAYER_8X8 = np.array([[ 0, 32,  8, 40,  2, 34, 10, 42],
+                      [48, 16, 56, 24, 50, 18, 58, 26],
+                      [12, 44,  4, 36, 14, 46,  6, 38],
+                      [60, 28, 52, 20, 62, 30, 54, 22],
+                      [ 3, 35, 11, 43,  1, 33,  9, 41],
+                      [51, 19, 59, 27, 49, 17, 57, 25],
+                      [15, 47,  7, 39, 13, 45,  5, 37],
+                      [63, 31, 55, 23, 61, 29, 53, 21]]) / 64 - 0.5
+
+# converts an array of RGB colors (last axis) into the CIELAB color space
+def rgb_to_lab(rgb):
+    c = np.asarray(rgb, np.float64) / 255
+    # undo the sRGB gamma
+    c = np.where(c > 0.04045, ((c + 0.055) / 1.055) ** 2.4, c / 12.92)
+    xyz = c @ np.array([[0.4124, 0.2126, 0.0193],
+                        [0.3576, 0.7152, 0.1192],
+                        [0.1805, 0.0722, 0.9505]])
+    # D65 white point
+    xyz /= (0.95047, 1.0, 1.08883)
+    f = np.where(xyz > 216 / 24389, np.cbrt(xyz), (24389 / 27 * xyz + 16) / 116)
+    return np.stack((116 * f[..., 1] - 16,
+                     500 * (f[..., 0] - f[..., 1]),
+                     200 * (f[..., 1] - f[..., 2])), axis=-1)
+
+# converts RGB colors into the space the metric measures distances in
+def metric_space(rgb, metric):
+    if metric == 'lab':
+        return rgb_to_lab(rgb)
+    return np.asarray(rgb, np.float64)
+
+# finds the index of the nearest palette point for every point in an (N, 3) array
+def nearest_colors(points, pal_points):
+    out = np.empty(len(points), np.intp)
+    # go in blocks so the (N, P) distance matrix stays small
+    for s in range(0, len(points), 65536):
+        block = points[s:s + 65536]
+        dist = ((block[:, None, :] - pal_points[None, :, :]) ** 2).sum(axis=2)
+        # argmin picks the first of equally close colors, just like a linear scan
+        out[s:s + 65536] = dist.argmin(axis=1)
+    return out
+
+# Floyd-Steinberg dithering, vectorized over anti-diagonal wavefronts:
+# all pixels with the same x + 2y only depend on pixels from earlier wavefronts
+def dither_floyd_steinberg(rgb, transparent, palette, pal_points, metric):
+    h, w = transparent.shape
+    work = rgb.astype(np.float64)
+    idxs = np.zeros((h, w), np.intp)
+    ys, xs = np.indices((h, w))
+    front = (xs + 2 * ys).ravel()
+    order = np.argsort(front, kind='stable')
+    bounds = np.searchsorted(front[order], np.arange(w + 2 * h))
+    opaque = ~transparent.ravel()
+    for t in range(len(bounds) - 1):
+        flat = order[bounds[t]:bounds[t + 1]]
+        flat = flat[opaque[flat]]
+        if len(flat) == 0:
+            continue
+        y, x = flat // w, flat % w
+        clr = np.clip(work[y, x], 0, 255)
+        best = nearest_colors(metric_space(clr, metric), pal_points)
+        idxs[y, x] = best
+        err = clr - palette[best]
+        # push the error to the neighbours that haven't been processed yet
+        for dy, dx, k in ((0, 1, 7 / 16), (1, -1, 3 / 16), (1, 0, 5 / 16), (1, 1, 1 / 16)):
+            ny, nx = y + dy, x + dx
+            ok = (ny < h) & (nx >= 0) & (nx < w)
+            np.add.at(work, (ny[ok], nx[ok]), err[ok] * k)
+    return idxs
+
+# converts a BGR(A) image into palette indices (255 is transparent)
+def quantize_image(img, colors, metric='rgb', dither='none'):
+    # grayscale images don't have a channel axis
+    if img.ndim == 2:
+        img = np.repeat(img[:, :, None], 3, axis=2)
+    h, w = img.shape[:2]
+    if img.shape[2] == 4: # the image has an alpha channel
+        transparent = img[:, :, 3] <= 128
+    else: # the image doesn't have an alpha channel
+        transparent = np.zeros((h, w), bool)
+    # PixelPlanet uses RGB, OpenCV uses BGR, need to swap
+    rgb = img[:, :, 2::-1]
+    # ignore the first two colors, they show the land a water colors and are not allowed in the request
+    palette = np.array(colors[2:], np.float64)
+    pal_points = metric_space(palette, metric)
+
+    if dither == 'floyd-steinberg':
+        idxs = dither_floyd_steinberg(rgb, transparent, palette, pal_points, metric)[~transparent]
+    else:
+        if dither == 'ordered':
+            # spread the threshold over roughly one palette step
+            ys, xs = np.ogrid[:h, :w]
+            rgb = np.clip(rgb + BAYER_8X8[ys % 8, xs % 8][:, :, None] * 32, 0, 255).round()
+        rgb = rgb.astype(np.uint32)
+        # only match every distinct color once
+        packed = (rgb[:, :, 0] << 16) | (rgb[:, :, 1] << 8) | rgb[:, :, 2]
+        uniq, inverse = np.unique(packed[~transparent], return_inverse=True)
+        uniq_rgb = np.stack(((uniq >> 16) & 0xFF, (uniq >> 8) & 0xFF, uniq & 0xFF), axis=1)
+        idxs = nearest_colors(metric_space(uniq_rgb, metric), pal_points)[inverse.ravel()]
+
+    color_idxs = np.full((h, w), 255, np.uint8)
+    color_idxs[~transparent] = idxs + 2
+    return color_idxs
+
+# makes a BGR lookup table out of a palette
+def bgr_lut(colors):
+    lut = np.zeros((256, 3), np.uint8)
+    lut[:len(colors)] = np.array(colors, np.uint8)[:, ::-1]
+    return lut
+
+# renders palette indices into a BGRA preview image
+def build_preview(color_idxs, colors):
+    h, w = color_idxs.shape
+    preview = np.empty((h, w, 4), np.uint8)
+    preview[:, :, :3] = bgr_lut(colors)[color_idxs]
+    preview[:, :, 3] = 255
+    # checkerboard pattern in transparent parts of the image
+    ys, xs = np.ogrid[:h, :w]
+    checker = np.where((ys % 10 >= 5) == (xs % 10 >= 5), 128, 64).astype(np.uint8)
+    transparent = color_idxs == 255
+    preview[transparent, :3] = checker[transparent][:, None]
+    return preview
+
+# change this when quantize_image() starts giving different results,
+#  so that templates converted by older versions aren't used
+TEMPLATE_CACHE_VERSION = 1
+
+# converts an image file into palette indices, or loads them if the same image has been
+#  converted with the same palette, settings and canvas before
+# cached templates are memory-mapped, so opening even a huge one is instant and
+#  bot processes drawing the same image share it instead of each keeping a copy
+# returns read-only (palette indices, transparency mask), or None if the image can't be decoded
+def load_template(img_path, canv_id, colors, metric='rgb', dither='none', cache_dir=CACHE_DIR):
+    with open(img_path, 'rb') as f:
+        content = f.read()
+    image_hash = hashlib.sha256(content).hexdigest()
+    palette_hash = hashlib.sha256(json.dumps(colors).encode()).hexdigest()
+    key = hashlib.sha256(f'{TEMPLATE_CACHE_VERSION}:{image_hash}:{palette_hash}:{metric}:{dither}:{canv_id}'.encode()).hexdigest()
+    base = None if cache_dir is None else path.join(cache_dir, 'templates', key)
+    if base is not None and path.exists(base + '.npy') and path.exists(base + '.mask.npy'):
+        try:
+            return np.load(base + '.npy', mmap_mode='r'), np.load(base + '.mask.npy', mmap_mode='r')
+        except (OSError, ValueError):
+            pass
+
+    import cv2
+    img = cv2.imdecode(np.frombuffer(content, np.uint8), cv2.IMREAD_UNCHANGED)
+    if img is None:
+        return None
+    print(f'{Fore.YELLOW}Processing the image{Style.RESET_ALL}')
+    color_idxs = quantize_image(img, colors, metric, dither)
+    transparent = color_idxs == 255
+    if base is not None:
+        # the indices go last, a template without them is never loaded
+        for file, array in ((base + '.mask.npy', transparent), (base + '.npy', color_idxs)):
+            write_file(file, functools.partial(np.save, arr=array))
+    color_idxs.flags.writeable = False
+    transparent.flags.writeable = False
+    return color_idxs, transparent
+
+# downloads chunks over a pooled connection and keeps them in a disk cache
+# chunk bodies are stored by their hash, the index maps (canvas, x, y) to a hash
+#  and to the validators the server sent so they can be revalidated cheaply
+# (and to the server, chunks cached from another one don't count)
+class ChunkLoader:
+    def __init__(self, cache_dir=CACHE_DIR, workers=8, retries=4):
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _index_path(self, d, x, y):
+        return path.join(self.cache_dir, 'chunks', str(d), f'{x}.{y}.json')
+
+    def _blob_path(self, digest):
+        return path.join(self.cache_dir, 'blobs', digest[:2], digest)
+
+    def _cached(self, d, x, y):
+        try:
+            with open(self._index_path(d, x, y)) as f:
+                entry = json.load(f)
+            if entry['url'] != PPFUN_URL:
+                return None, None
+            with open(self._blob_path(entry['hash']), 'rb') as f:
+                return entry, f.read()
+        except (OSError, ValueError, KeyError, TypeError):
+            return None, None
+
+    # gets raw chunk data, from the cache if the server says it hasn't changed
+    def fetch(self, d, x, y):
+        entry, body = (None, None) if self.cache_dir is None else self._cached(d, x, y)
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        try:
+            response = self.session.get(f'{PPFUN_URL}/chunks/{d}/{x}/{y}.bmp', headers=headers, timeout=30)
+            if response.status_code == 304 and body is not None:
+                return body
+            response.raise_for_status()
+        except requests.RequestException:
+            # better slightly stale data than none at all
+            if body is not None:
+                print(f'{Fore.RED}Failed to load chunk ({x}, {y}), using a cached copy{Style.RESET_ALL}')
+                return body
+            raise
+        body = response.content
+        if self.cache_dir is not None:
+            digest = hashlib.sha256(body).hexdigest()
+            if not path.exists(self._blob_path(digest)):
+                write_file(self._blob_path(digest), body)
+            write_file(self._index_path(d, x, y), json.dumps({
+                'url': PPFUN_URL,
+                'hash': digest,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified')}).encode())
+        return body
+
+    # deletes the chunk bodies no index entry points to, like the old versions of chunks that changed
+    # (blobs of other bot processes that haven't written their index entries yet may go too,
+    #  they are then just downloaded again)
+    def prune(self):
+        if self.cache_dir is None:
+            return
+        used = set()
+        for root, _, files in os.walk(path.join(self.cache_dir, 'chunks')):
+            for name in files:
+                try:
+                    with open(path.join(root, name)) as f:
+                        used.add(json.load(f)['hash'])
+                except (OSError, ValueError, KeyError, TypeError):
+                    pass
+        for root, _, files in os.walk(path.join(self.cache_dir, 'blobs')):
+            # (files still being written end in .tmp)
+            for name in files:
+                if len(name) == 64 and name not in used:
+                    try:
+                        os.remove(path.join(root, name))
+                    except OSError:
+                        pass
+
+    # fetches several chunks concurrently, yields ((x, y), data) as they arrive
+    def fetch_many(self, d, coords):
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            futures = {pool.submit(self.fetch, d, x, y): (x, y) for x, y in coords}
+            for future in concurrent.futures.as_completed(futures):
+                yield futures[future], future.result()
+
+# the loader used by get_chunk() and the chunk stores
+chunk_loader = ChunkLoader()
+
+# decodes a raw chunk into color indices and a protection mask
+# (the server sends short or empty bodies for chunks nobody has painted yet)
+def decode_chunk(data, out=None, prot_out=None):
+    if out is None:
+        out = np.empty((256, 256), np.uint8)
+    raw = np.frombuffer(data, np.uint8, count=min(len(data), 65536))
+    if len(raw) < 65536:
+        raw = np.concatenate((raw, np.zeros(65536 - len(raw), np.uint8)))
+    raw = raw.reshape((256, 256))
+    # protected pixels are shifted up by 128
+    np.bitwise_and(raw, 0x7F, out=out)
+    if prot_out is not None:
+        np.greater_equal(raw, 128, out=prot_out)
+    return out
+
 # gets raw chunk data from the server
 def get_chunk(d, x, y):
-    # get data from the server
-    data = requests.get(f'https://pixelplanet.fun/chunks/{d}/{x}/{y}.bmp').content
-    # construct a numpy array from it
-    arr = np.zeros((256, 256), np.uint8)
-    for i in range(65536):
-        c = data[i]
-        # protected pixels are shifted up by 128
-        if c >= 128:
-            c = c - 128
-        arr[i // 256, i % 256] = c
-    return arr
-
-# gets several map chunks from the server
-def get_chunks(d, xs, ys, w, h):
-    # the final image
-    data = np.zeros((0, w * 256), np.uint8)
-    # go through the chunks
-    for y in range(h):
-        # the row
-        row = np.zeros((256, 0), np.uint8)
-        for x in range(w):
-            # append the chunk to the row
-            row = np.concatenate((row, get_chunk(d, x + xs, y + ys)), axis=1)
-        # append the row to the image
-        data = np.concatenate((data, row), axis=0)
-    return data
+    return decode_chunk(chunk_loader.fetch(d, x, y))
+
+# map chunks of one canvas, loaded only where they're needed
+# chunks are 256x256 tiles kept by their (i, j) chunk coordinates,
+#  pixels are read and written by their canvas coordinates
+# with memmap_dir, the tiles are kept in files there instead of in memory
+class ChunkStore:
+    def __init__(self, d, memmap_dir=None):
+        self.d = d
+        self.half = canvas_geometry(d).half
+        self.memmap_dir = memmap_dir
+        # (i, j) -> color indices
+        self.tiles = {}
+        # (i, j) -> protected pixels
+        self.protection = {}
+
+    def _new_tile(self, i, j):
+        if self.memmap_dir is None:
+            return np.empty((256, 256), np.uint8)
+        os.makedirs(self.memmap_dir, exist_ok=True)
+        return np.memmap(path.join(self.memmap_dir, f'{self.d}.{i}.{j}.bin'), np.uint8, 'w+', shape=(256, 256))
+
+    # loads chunks from the server, several at once
+    def load(self, coords):
+        coords = [c for c in coords if c not in self.tiles]
+        for (i, j), raw in chunk_loader.fetch_many(self.d, coords):
+            prot = np.empty((256, 256), bool)
+            self.tiles[i, j] = decode_chunk(raw, self._new_tile(i, j), prot)
+            self.protection[i, j] = prot
+
+    # gets a chunk, loading it if it hasn't been loaded yet
+    def tile(self, i, j):
+        if (i, j) not in self.tiles:
+            self.load([(i, j)])
+        return self.tiles[i, j]
+
+    def get_pixel(self, x, y):
+        x, y = x + self.half, y + self.half
+        return self.tile(x >> 8, y >> 8)[y & 0xFF, x & 0xFF]
+
+    def set_pixel(self, x, y, c):
+        x, y = x + self.half, y + self.half
+        self.tile(x >> 8, y >> 8)[y & 0xFF, x & 0xFF] = c
+
+    # groups pixels by the loaded chunk they're in,
+    #  yields (tile, x in the tile, y in the tile, indices of the pixels)
+    def _by_tile(self, xs, ys):
+        gx = np.asarray(xs, np.int64) + self.half
+        gy = np.asarray(ys, np.int64) + self.half
+        keys = (gy >> 8) * 256 + (gx >> 8)
+        order = np.argsort(keys, kind='stable')
+        uniq, starts = np.unique(keys[order], return_index=True)
+        for key, idx in zip(uniq.tolist(), np.split(order, starts[1:])):
+            tile = self.tiles.get((key % 256, key // 256))
+            if tile is not None:
+                yield tile, gx[idx] & 0xFF, gy[idx] & 0xFF, idx
+
+    # reads pixels, the ones in chunks that aren't loaded are fill
+    def get(self, xs, ys, fill=0):
+        out = np.full(len(xs), fill, np.uint8)
+        for tile, lx, ly, idx in self._by_tile(xs, ys):
+            out[idx] = tile[ly, lx]
+        return out
+
+    # writes pixels, the ones in chunks that aren't loaded are ignored
+    # returns which ones were written
+    def set(self, xs, ys, cs):
+        written = np.zeros(len(xs), bool)
+        for tile, lx, ly, idx in self._by_tile(xs, ys):
+            tile[ly, lx] = cs[idx]
+            written[idx] = True
+        return written
+
+    # copies a rectangle into a dense array, parts in chunks that aren't loaded are fill
+    # with a step, only every step-th pixel of it is copied (so a huge area never has to be in memory)
+    def region(self, x, y, w, h, fill=0, step=1):
+        out = np.full((-(-h // step), -(-w // step)), fill, np.uint8)
+        gx, gy = x + self.half, y + self.half
+        for j in range(gy >> 8, ((gy + h - 1) >> 8) + 1):
+            for i in range(gx >> 8, ((gx + w - 1) >> 8) + 1):
+                tile = self.tiles.get((i, j))
+                if tile is None:
+                    continue
+                # the first sampled pixels in the chunk
+                x0, x1 = max(gx, i * 256), min(gx + w, i * 256 + 256)
+                y0, y1 = max(gy, j * 256), min(gy + h, j * 256 + 256)
+                x0, y0 = x0 + (gx - x0) % step, y0 + (gy - y0) % step
+                if x0 >= x1 or y0 >= y1:
+                    continue
+                part = tile[y0 - j * 256:y1 - j * 256:step, x0 - i * 256:x1 - i * 256:step]
+                oy, ox = (y0 - gy) // step, (x0 - gx) // step
+                out[oy:oy + part.shape[0], ox:ox + part.shape[1]] = part
+        return out
+
+    # the smallest rectangle with all loaded chunks in it, as (x, y, w, h)
+    def bounds(self):
+        i0, i1 = min(i for i, _ in self.tiles), max(i for i, _ in self.tiles)
+        j0, j1 = min(j for _, j in self.tiles), max(j for _, j in self.tiles)
+        return i0 * 256 - self.half, j0 * 256 - self.half, (i1 - i0 + 1) * 256, (j1 - j0 + 1) * 256
+
+# finds the chunks with at least one opaque template pixel in them
+# returns a list of (i, j) chunk coordinates
+def template_chunks(d, transparent, draw_x, draw_y):
+    half = canvas_geometry(d).half
+    h, w = transparent.shape
+    # template rows and columns where a new chunk begins
+    row_starts = np.unique(np.r_[0, np.arange(-(draw_y + half) % 256, h, 256)])
+    col_starts = np.unique(np.r_[0, np.arange(-(draw_x + half) % 256, w, 256)])
+    opaque = np.logical_or.reduceat(~np.asarray(transparent), row_starts, axis=0)
+    opaque = np.logical_or.reduceat(opaque, col_starts, axis=1)
+    j0, i0 = (draw_y + half) >> 8, (draw_x + half) >> 8
+    js, is_ = np.nonzero(opaque)
+    return [(i0 + i, j0 + j) for j, i in zip(js.tolist(), is_.tolist())]
+
+# BGR lookup tables of the canvases
+canvas_luts = {}
+
+# gets the BGR lookup table of a canvas
+def canvas_lut(d):
+    global me
+    if d not in canvas_luts:
+        canvas_luts[d] = bgr_lut(me['canvases'][str(d)]['colors'])
+    return canvas_luts[d]
+
+# calculates the sampling step that makes an image fit the preview window
+def preview_step(shape, max_w=PREVIEW_MAX_W, max_h=PREVIEW_MAX_H):
+    return max(1, math.ceil(shape[0] / max_h), math.ceil(shape[1] / max_w))
 
 # renders chunk as colored CV2 image
 def render_chunk(d, x, y):
-    global me
-    data = get_chunk(d, x, y)
-    img = np.zeros((256, 256, 3), np.uint8)
-    colors = me['canvases'][str(d)]['colors']
-    # go through the data
-    for y in range(256):
-        for x in range(256):
-            r, g, b = colors[data[y, x]]
-            img[y, x] = (b, g, r)
-    return img
+    return canvas_lut(d)[get_chunk(d, x, y)]
 
 # renders map data into a colored CV2 image
-def render_map(d, data):
-    global me
-    img = np.zeros((data.shape[0], data.shape[1], 3), np.uint8)
-    colors = me['canvases'][str(d)]['colors']
-    # go through the data
-    for y in range(data.shape[0]):
-        for x in range(data.shape[1]):
-            r, g, b = colors[data[y, x]]
-            img[y, x] = (b, g, r)
+# only every step-th pixel is rendered, so huge areas can be previewed cheaply
+# if a template is given, it's blended over the map with its top-left corner at offset
+#  (the offset can be negative, the parts outside of the map are left out)
+def render_map(d, data, step=1, template=None, offset=(0, 0), alpha=0.6):
+    lut = canvas_lut(d)
+    img = lut[data[::step, ::step]]
+    if template is not None:
+        off_x, off_y = offset
+        # the first template pixels that are on the map and land on the sampled grid
+        t_y, t_x = max(0, -off_y), max(0, -off_x)
+        t_y, t_x = t_y + (-(off_y + t_y)) % step, t_x + (-(off_x + t_x)) % step
+        tmpl = template[t_y::step, t_x::step]
+        y0, x0 = (off_y + t_y) // step, (off_x + t_x) // step
+        region = img[y0:y0 + tmpl.shape[0], x0:x0 + tmpl.shape[1]]
+        tmpl = tmpl[:region.shape[0], :region.shape[1]]
+        opaque = tmpl != 255
+        region[opaque] = (region[opaque] * (1 - alpha) + lut[tmpl[opaque]] * alpha).astype(np.uint8)
     return img
 
+# binary protocol packets
+SELECT_CANVAS  = struct.Struct('>BB')     # 0xA0, canvas
+REGISTER_CHUNK = struct.Struct('>BBB')    # 0xA1, i, j
+PIXEL          = struct.Struct('>BBBBHB') # 0xC1, i, j, offset (24 bits), color
+PIXEL_RETURN   = struct.Struct('>BBIH')   # 0xC3, return code, wait (ms), cooldown (s)
+TOTAL_COOLDOWN = struct.Struct('>BI')     # 0xC2, cooldown (ms)
+ONLINE_COUNTER = struct.Struct('>BH')     # 0xA7, number of users online
+
+# the same layout as PIXEL for converting many packets at once
+PIXEL_DTYPE = np.dtype([('op', 'u1'), ('i', 'u1'), ('j', 'u1'), ('offs_hi', 'u1'), ('offs', '>u2'), ('clr', 'u1')])
+
+# decoded packets
+PixelUpdate   = collections.namedtuple('PixelUpdate', 'i j offs clr')
+PixelReturn   = collections.namedtuple('PixelReturn', 'rc wait cd_s')
+TotalCooldown = collections.namedtuple('TotalCooldown', 'wait')
+OnlineCounter = collections.namedtuple('OnlineCounter', 'online')
+ChatMessage   = collections.namedtuple('ChatMessage', 'name text country raw')
+UnknownPacket = collections.namedtuple('UnknownPacket', 'data')
+
+def _decode_pixel_update(data):
+    _, i, j, offs_hi, offs, clr = PIXEL.unpack_from(data)
+    return PixelUpdate(i, j, (offs_hi << 16) | offs, clr)
+
+def _decode_pixel_return(data):
+    return PixelReturn(*PIXEL_RETURN.unpack_from(data)[1:])
+
+def _decode_total_cooldown(data):
+    return TotalCooldown(TOTAL_COOLDOWN.unpack_from(data)[1])
+
+def _decode_online_counter(data):
+    return OnlineCounter(ONLINE_COUNTER.unpack_from(data)[1])
+
+# binary packet decoders by opcode
+DECODERS = {
+    0xC1: _decode_pixel_update,
+    0xC3: _decode_pixel_return,
+    0xC2: _decode_total_cooldown,
+    0xA7: _decode_online_counter,
+}
+
+# decodes a message from the server into one of the packet tuples
+def decode_packet(data):
+    # text data = chat message
+    if type(data) == str:
+        # data comes as a JS array
+        msg = json.loads(data)
+        return ChatMessage(msg[0], msg[1], msg[2], msg)
+    decoder = DECODERS.get(data[0]) if len(data) > 0 else None
+    try:
+        return decoder(data) if decoder else UnknownPacket(data)
+    except struct.error:
+        return UnknownPacket(data)
+
+# decodes many pixel update packets into arrays of i, j, offset and color
+def decode_pixel_updates(packets):
+    arr = np.frombuffer(b''.join(packets), PIXEL_DTYPE)
+    return arr['i'], arr['j'], (arr['offs_hi'].astype(np.int64) << 16) | arr['offs'], arr['clr']
+
+# converts between canvas coordinates and the chunk/offset form packets use
+# works with plain numbers and with numpy arrays alike
+class CanvasGeometry:
+    def __init__(self, size):
+        self.size = size
+        self.half = size // 2
+        self.mod_offs = self.half % 256
+
+    def to_packet(self, x, y):
+        offs = (((y + self.mod_offs) % 256) * 256) + ((x + self.mod_offs) % 256)
+        return (x + self.half) // 256, (y + self.half) // 256, offs
+
+    def from_packet(self, i, j, offs):
+        return (i * 256) - self.half + (offs & 0xFF), (j * 256) - self.half + ((offs >> 8) & 0xFF)
+
+# geometries of the canvases
+canvas_geometries = {}
+
+# gets the geometry of a canvas
+def canvas_geometry(d):
+    global me
+    if d not in canvas_geometries:
+        canvas_geometries[d] = CanvasGeometry(me['canvases'][str(d)]['size'])
+    return canvas_geometries[d]
+
+# encodes pixel placement packets for arrays of coordinates and colors
+def encode_pixels(d, xs, ys, cs):
+    i, j, offs = canvas_geometry(d).to_packet(np.asarray(xs), np.asarray(ys))
+    arr = np.empty(len(i), PIXEL_DTYPE)
+    arr['op'] = 0xC1
+    arr['i'] = i
+    arr['j'] = j
+    arr['offs_hi'] = offs >> 16
+    arr['offs'] = offs & 0xFFFF
+    arr['clr'] = cs
+    data = arr.tobytes()
+    return [data[n:n + PIXEL.size] for n in range(0, len(data), PIXEL.size)]
+
 # selects a canvas for future use
 def select_canvas(ws, d):
-    # construct the data array
-    data = bytearray(2)
-    data[0] = 0xA0
-    data[1] = d
-    # send data
-    ws.send_binary(data)
+    ws.send_binary(SELECT_CANVAS.pack(0xA0, d))
 
 # register a chunk
 def register_chunk(ws, d, x, y):
-    # construct the data array
-    data = bytearray(3)
-    data[0] = 0xA1
-    data[1] = x
-    data[2] = y
-    # send data
-    ws.send_binary(data)
+    ws.send_binary(REGISTER_CHUNK.pack(0xA1, x, y))
 
 # places a pixel
 def place_pixel(ws, d, x, y, c):
     # convert the X and Y coordinates to I, J and Offset
-    csz = me['canvases'][str(d)]['size']
-    modOffs = (csz // 2) % 256
-    offs = (((y + modOffs) % 256) * 256) + ((x + modOffs) % 256)
-    i = (x + csz // 2) // 256
-    j = (y + csz // 2) // 256
-    # construct the data array
-    data = bytearray(7)
-    data[0] = 0xC1
-    data[1] = i
-    data[2] = j
-    data[3] = (offs >> 16) & 0xFF
-    data[4] = (offs >>  8) & 0xFF
-    data[5] = (offs >>  0) & 0xFF
-    data[6] = c
-    # send data
-    ws.send_binary(data)
-
-# draws the image
-def draw_function(ws, canv_id, draw_x, draw_y, c_start_x, c_start_y, img, defend, strategy):
-    global me, draw, succ, chunk_data, pixels_drawn, start_time
-
-    size = img.shape
-    canv_sz = me['canvases'][str(canv_id)]['size']
-    canv_clr = me['canvases'][str(canv_id)]['colors']
-
-    # fill a list of coordinates based on the strategy
-    coords = []
-    if strategy == 'forward':
-        for y in range(size[0]):
-            for x in range(size[1]):
-                coords.append((x, y))
-    elif strategy == 'backward':
-        for y in range(size[0] - 1, -1, -1):
-            for x in range(size[1] - 1, -1, -1):
-                coords.append((x, y))
+    i, j, offs = canvas_geometry(d).to_packet(x, y)
+    ws.send_binary(PIXEL.pack(0xC1, i, j, offs >> 16, offs & 0xFFFF, c))
+
+# models the server's cooldown as a token bucket: every pixel adds its cooldown
+#  to a counter that drains in real time, and pixels can be placed as long as
+#  the counter stays below the canvas' stack limit
+class CooldownScheduler:
+    # safety margin added to every wait, in seconds
+    MARGIN = 0.05
+
+    def __init__(self, canv_desc=None):
+        canv_desc = canv_desc or {}
+        # cooldown of a pixel and the stack limit, in seconds
+        self.cost = canv_desc.get('bcd', 0) / 1000
+        self.stack = max(canv_desc.get('cds', 0) / 1000, self.cost)
+        # time.monotonic() when the counter drains to zero
+        self.empty_at = 0
+        # time.monotonic() until which placing is paused after an error
+        self.paused_until = 0
+
+    # the server reported the current counter value
+    def update(self, wait_ms, cd_s=None):
+        self.empty_at = time.monotonic() + wait_ms / 1000
+        if cd_s:
+            self.cost = cd_s
+
+    # pauses placing for a while
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    # how long to wait before the next pixel can be placed, in seconds
+    def delay(self):
+        now = time.monotonic()
+        until = self.empty_at - self.stack + self.cost - now
+        return max(until + self.MARGIN if until > 0 else 0, self.paused_until - now)
+
+    async def wait(self):
+        delay = self.delay()
+        metrics.observe('ppfun2_cooldown_wait_seconds', delay)
+        if delay > 1:
+            logger.log(f'{Fore.YELLOW}Cooling down for {Fore.GREEN}{"{:.1f}".format(delay)}{Fore.YELLOW} s{Style.RESET_ALL}', event='cooldown')
+        await asyncio.sleep(delay)
+
+# a WebSocket connection to the server driven by asyncio
+# reading and writing happen in separate tasks, so pixel updates keep coming in
+#  while we wait for a placement to be confirmed or for the cooldown to run out
+# (websocket_client is blocking, so the actual I/O runs in threads of the session's own,
+#  so that many sessions waiting for messages don't use up the default executor)
+class Client:
+    # how long to wait for the server to confirm a placement, in seconds
+    PLACE_TIMEOUT = 15
+
+    def __init__(self, on_message, headers=None, proxy_host=None, proxy_port=None):
+        self.on_message = on_message
+        self.headers = headers or []
+        self.proxy_host = proxy_host
+        self.proxy_port = proxy_port
+        self.ws = None
+        self.outbox = asyncio.Queue()
+        # placements waiting for a pixel return packet, oldest first
+        self.pending = collections.deque()
+        # the selected canvas
+        self.canvas = None
+        # the cooldown is counted separately on every canvas
+        self.schedulers = {}
+        # number of failed placements in a row
+        self.failures = 0
+        # why the session can't place pixels anymore, None if it can
+        self.dropped = None
+        # if set, raw pixel updates go there instead of to on_message
+        self.updates = None
+        # one thread waits for messages, the other one sends them
+        self.executor = concurrent.futures.ThreadPoolExecutor(2, thread_name_prefix='Session')
+
+    async def connect(self):
+        self.ws = await asyncio.get_running_loop().run_in_executor(None, functools.partial(
+            websocket.create_connection, PPFUN_WS_URL, header=self.headers,
+            http_proxy_host=self.proxy_host, http_proxy_port=self.proxy_port))
+
+    @property
+    def scheduler(self):
+        global me
+        if self.canvas not in self.schedulers:
+            self.schedulers[self.canvas] = CooldownScheduler(None if self.canvas is None else me['canvases'][str(self.canvas)])
+        return self.schedulers[self.canvas]
+
+    # selects the canvas of a chunk store unless it's selected already
+    # the session that receives pixel updates also registers the chunks of the store
+    #  (the server forgets the registered chunks when the canvas changes)
+    def select(self, store):
+        if self.canvas == store.d:
+            return
+        select_canvas(self, store.d)
+        if self.updates is not None:
+            for i, j in sorted(store.tiles):
+                register_chunk(self, store.d, i, j)
+        self.canvas = store.d
+
+    def close(self):
+        if self.ws is not None:
+            # wakes up the reader thread
+            self.ws.abort()
+            self.ws.close()
+        self.executor.shutdown(wait=False)
+
+    # queues binary data to be sent by the writer task
+    def send_binary(self, data):
+        self.outbox.put_nowait(bytes(data))
+
+    async def _reader(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            data = await loop.run_in_executor(self.executor, self.ws.recv)
+            # pixel updates are decoded in batches later
+            # (the packets don't say which canvas they're from, the one selected when
+            #  they arrive is assumed)
+            if self.updates is not None and type(data) != str and len(data) == PIXEL.size and data[0] == 0xC1:
+                self.updates.put(self.canvas, data)
+                continue
+            packet = decode_packet(data)
+            if type(packet) == PixelReturn:
+                self._pixel_return(packet)
+            elif type(packet) == TotalCooldown:
+                self._total_cooldown(packet)
+            else:
+                self.on_message(packet)
+
+    async def _writer(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            data = await self.outbox.get()
+            await loop.run_in_executor(self.executor, self.ws.send_binary, data)
+
+    # pixel return packet
+    def _pixel_return(self, packet):
+        rc, wait, cd_s = packet
+        logger.log(f'{Fore.YELLOW}Pixel return{Fore.YELLOW} (code: {Fore.RED if rc != 0 else Fore.GREEN}{rc}{Fore.YELLOW}): ' + 
+                f'wait: {Fore.GREEN}{wait}{Fore.YELLOW} ms {Fore.GREEN}[+{cd_s} s]{Style.RESET_ALL}', DEBUG, 'pixel_return')
+        # the counter is only reported when it's been updated
+        if rc in (0, 9):
+            self.scheduler.update(wait, cd_s)
+        # the server answers in order, so this is the answer to the oldest placement
+        #  (if that one has timed out, the answer came too late and is dropped)
+        if self.pending:
+            future = self.pending.popleft()
+            if not future.done():
+                future.set_result(packet)
+
+    # total cooldown packet
+    def _total_cooldown(self, packet):
+        cd = packet.wait
+        logger.log(f'{Fore.YELLOW}Total cooldown: {Fore.GREEN}{cd} ms{Style.RESET_ALL}', DEBUG)
+        self.scheduler.update(cd)
+
+    # places a pixel, returns the PixelReturn packet from the server
+    #  or None if it didn't answer
+    async def place(self, d, x, y, c):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append(future)
+        place_pixel(self, d, x, y, c)
+        sent = time.monotonic()
+        try:
+            result = await asyncio.wait_for(asyncio.shield(future), self.PLACE_TIMEOUT)
+        except asyncio.TimeoutError:
+            # stays pending, so a late answer isn't taken for the answer to the next one
+            future.cancel()
+            metrics.inc('ppfun2_placements_total', code='timeout')
+            return None
+        metrics.observe('ppfun2_placement_rtt_seconds', time.monotonic() - sent)
+        metrics.inc('ppfun2_placements_total', code=result.rc)
+        return result
+
+    # starts reading and writing messages
+    def start(self):
+        return [asyncio.create_task(self._reader()), asyncio.create_task(self._writer())]
+
+# runs a coroutine while the clients read and write messages
+# returns when the coroutine finishes or a connection breaks
+# (background coroutines run alongside and are stopped along with the connections)
+async def run_sessions(clients, coro, background=()):
+    tasks = [task for client in clients for task in client.start()] + [asyncio.create_task(coro)]
+    tasks += [asyncio.create_task(bg) for bg in background]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        for client in clients:
+            client.close()
+
+# a thread-safe set of template pixels that may need repairing
+# (pixels are kept as arrays of coordinates by job, and may repeat)
+class DirtySet:
+    def __init__(self):
+        self.pixels = collections.defaultdict(list)
+        self.cond = threading.Condition()
+
+    def add(self, job, x, y):
+        self.add_many(job, np.array([x]), np.array([y]))
+
+    def add_many(self, job, xs, ys):
+        with self.cond:
+            self.pixels[job].append((xs, ys))
+            self.cond.notify()
+
+    # stops take() from waiting
+    def wake(self):
+        with self.cond:
+            self.cond.notify_all()
+
+    # takes all pixels, waiting up to timeout seconds for some to appear
+    # returns a list of (job, xs, ys)
+    def take(self, timeout=0):
+        with self.cond:
+            if not self.pixels and timeout > 0:
+                self.cond.wait(timeout)
+            pixels, self.pixels = self.pixels, collections.defaultdict(list)
+        return [(job, np.concatenate([xs for xs, _ in parts]), np.concatenate([ys for _, ys in parts]))
+                for job, parts in pixels.items()]
+
+# makes keys that compare palette entries by their color value
+# (water and land have seprate indicies, but the same color values as regular colors)
+def color_keys(colors):
+    keys = np.full(256, -1, np.int64)
+    c = np.array(colors, np.int64)
+    keys[:len(c)] = (c[:, 0] << 16) | (c[:, 1] << 8) | c[:, 2]
+    return keys
+
+# finds the template pixels that don't match the canvas
+# (area is the part of the canvas the template covers)
+def template_mismatch(area, img, keys):
+    return (img != 255) & (keys[area] != keys[img])
+
+# the drawing strategies
+STRATEGIES = ['forward', 'backward', 'random', 'spiral', 'edges', 'color']
+
+# orders the non-transparent template pixels according to a strategy
+# (or only the ones selected by the mask, if there is one)
+# returns their flat indices (y * width + x)
+def plan_order(img, strategy, mask=None):
+    h, w = img.shape
+    flat = np.flatnonzero(img != 255 if mask is None else mask)
+    if strategy == 'backward':
+        return flat[::-1]
     elif strategy == 'random':
-        for y in range(size[0]):
-            for x in range(size[1]):
-                coords.append((x, y))
-        random.shuffle(coords)
+        return np.random.permutation(flat)
+    elif strategy == 'spiral':
+        # ring by ring from the center outwards, going around each ring
+        dy = flat // w - (h - 1) / 2
+        dx = flat % w - (w - 1) / 2
+        return flat[np.lexsort((np.arctan2(dy, dx), np.maximum(abs(dx), abs(dy))))]
+    elif strategy == 'edges':
+        # pixels next to a transparent one, the image border or another color go first
+        padded = np.pad(img, 1, constant_values=255)
+        edge = ((img != padded[:-2, 1:-1]) | (img != padded[2:, 1:-1]) |
+                (img != padded[1:-1, :-2]) | (img != padded[1:-1, 2:]))
+        return flat[np.argsort(~edge.ravel()[flat], kind='stable')]
+    elif strategy == 'color':
+        # one color after another
+        return flat[np.argsort(img.ravel()[flat], kind='stable')]
+    return flat
 
-    # calculate position in the chunk data array
-    start_in_d_x = draw_x + ((canv_sz // 2) - (c_start_x * 256))
-    start_in_d_y = draw_y + ((canv_sz // 2) - (c_start_y * 256))
+# iterates over the (x, y) coordinates of template pixels in a precomputed order
+class PlacementPlan:
+    def __init__(self, order, width):
+        self.order = order
+        self.width = width
+        self.pos = 0
 
-    start_time = datetime.datetime.now()
-    draw = True
+    def __len__(self):
+        return len(self.order)
 
-    while len(coords) > 0:
-        # get a coordinate
-        coord = coords[0]
-        x, y = (coord)
-        coords.remove(coord)
+    @property
+    def remaining(self):
+        return len(self.order) - self.pos
 
-        # check if the pixel is transparent
-        if img[y, x] == 255:
-            continue
+    def __iter__(self):
+        return self
 
-        succ = False
-        while not succ:
-            # we need to compare actual color values and not indicies
-            # because water and land have seprate indicies, but the same color values
-            #  as regular colors
-            if canv_clr[chunk_data[start_in_d_y + y, start_in_d_x + x]] != canv_clr[img[y, x]]:
-                pixels_remaining = len(coords)
-                sec_per_px = (datetime.datetime.now() - start_time).total_seconds() / pixels_drawn
-                time_remaining = datetime.timedelta(seconds=(pixels_remaining * sec_per_px))
-                print(f'{Fore.YELLOW}Placing a pixel at {Fore.GREEN}({x + draw_x}, {y + draw_y})' + 
-                    f'{Fore.YELLOW}, progress: {Fore.GREEN}{"{:2.4f}".format((y * size[0] + x) * 100 / (size[0] * size[1]))}%' +
-                    f'{Fore.YELLOW}, remaining: {Fore.GREEN}{"estimating" if pixels_drawn < 20 else str(time_remaining)}' +
-                    f'{Fore.YELLOW}, {Fore.GREEN}{pixels_drawn}{Fore.YELLOW} pixels placed{Style.RESET_ALL}')
-                # get the color index
-                c_idx = img[y, x]
-                # try to draw it
-                while not draw:
-                    time.sleep(0.25)
-                    pass
-                draw = False
-                place_pixel(ws, canv_id, x + draw_x, y + draw_y, c_idx)
-                # this flag will be reset when the other thread receives a confirmation message
-                while not draw:
-                    time.sleep(0.25)
-                    pass
-                if succ:
-                    pixels_drawn += 1
-                # wait half a second
-                # (a little bit of artifical fluctuation
-                #  so the server doesn't think we're a bot)
-                time.sleep(0.5 + random.uniform(-0.25, 0.25))
+    def __next__(self):
+        if self.pos >= len(self.order):
+            raise StopIteration
+        i = int(self.order[self.pos])
+        self.pos += 1
+        return i % self.width, i // self.width
+
+# what to do when the server refuses to place a pixel: (description, action, backoff in seconds)
+# 'skip' gives up on the pixel, 'retry' tries again after the backoff (doubling it with every
+#  failure in a row), 'cooldown' waits for the cooldown the server reported, 'drop' stops using
+#  the session (the account can't draw there, but the others might), 'fatal' stops the bot
+RETURN_CODES = {
+    1:  ('invalid canvas',                      'fatal',    0),
+    2:  ('invalid X coordinate',                'skip',     0),
+    3:  ('invalid Y coordinate',                'skip',     0),
+    4:  ('invalid Z coordinate',                'skip',     0),
+    5:  ('invalid color',                       'skip',     0),
+    6:  ('only registered users can place here', 'drop',   0),
+    7:  ('not enough pixels placed to use this canvas', 'drop', 0),
+    8:  ('the pixel is protected',              'skip',     0),
+    9:  ('cooldown',                            'cooldown', 0),
+    10: ('CAPTCHA required',                    'retry',    2),
+    11: ('proxy detected',                      'retry',    60),
+}
+# the longest backoff, in seconds
+MAX_BACKOFF = 120
+
+# raised when the server won't let us draw at all
+class PlacementError(Exception):
+    pass
+
+# places a pixel and waits for the server to confirm it
+# returns 'placed', 'retry' (the scheduler is paused if needed), 'skip'
+#  or 'drop' (client.dropped says why)
+async def place_and_confirm(client, canv_id, x, y, c):
+    loop = asyncio.get_running_loop()
+    result = await client.place(canv_id, x, y, c)
+    if result is not None and result.rc == 0:
+        client.failures = 0
+        return 'placed'
+
+    desc, action, backoff = ('no answer', 'retry', 2) if result is None else \
+        RETURN_CODES.get(result.rc, (f'error {result.rc}', 'retry', 2))
+    client.failures += 1
+    # CAPTCHA error
+    if result is not None and result.rc == 10 and client.failures == 1:
+        loop.run_in_executor(None, play_notification)
+        logger.log(Fore.RED + 'Place a pixel somewhere manually and enter CAPTCHA' + Style.RESET_ALL, WARNING)
+    if action == 'fatal':
+        raise PlacementError(desc)
+    if action == 'drop':
+        logger.log(f'{Fore.RED}Not using a session anymore: {desc}{Style.RESET_ALL}', WARNING)
+        client.dropped = desc
+        return 'drop'
+    if action == 'skip':
+        logger.log(f'{Fore.RED}Skipping the pixel at ({x}, {y}): {desc}{Style.RESET_ALL}', WARNING, 'skip')
+        return 'skip'
+    if action == 'retry':
+        delay = min(backoff * 2 ** (client.failures - 1), MAX_BACKOFF)
+        logger.log(f'{Fore.RED}Failed to place a pixel ({desc}), pausing the session for {delay} s{Style.RESET_ALL}', WARNING, 'retry')
+        client.scheduler.pause(delay)
+    return 'retry'
+
+# how much each template pixel matters for recognizing the image, from 0 to 1
+# pixels that differ a lot from their neighbours (outlines, edges, details) matter most,
+#  the ones in flat areas matter least
+def pixel_importance(img, colors):
+    h, w = img.shape
+    palette = np.zeros((256, 3), np.float32)
+    palette[:len(colors)] = colors
+    rgb = palette[img]
+    opaque = img != 255
+    padded = np.pad(rgb, ((1, 1), (1, 1), (0, 0)), mode='edge')
+    padded_opaque = np.pad(opaque, 1, constant_values=False)
+    contrast = np.zeros((h, w), np.float32)
+    for dy, dx in ((0, 1), (2, 1), (1, 0), (1, 2)):
+        diff = np.sqrt(((rgb - padded[dy:dy + h, dx:dx + w]) ** 2).sum(axis=2))
+        # the outline of the image is an edge too
+        diff[~padded_opaque[dy:dy + h, dx:dx + w]] = 255
+        np.maximum(contrast, diff, out=contrast)
+    return np.where(opaque, np.minimum(contrast / 255, 1), 0).astype(np.float32)
+
+# damage done to the pixels of an image, fading over time
+# (instead of fading the whole array all the time, new damage is added with a weight
+#  that grows over time, and the array is only rescaled when the weight gets too big)
+class HeatMap:
+    def __init__(self, shape, half_life=HEAT_HALF_LIFE):
+        self.rate = math.log(2) / half_life
+        self.start = time.monotonic()
+        # time.monotonic() when the weight was 1
+        self.origin = self.start
+        self.heat = np.zeros(shape, np.float32)
+        # time.monotonic() - start when the pixels were last damaged
+        self.last_hit = np.full(shape, -np.inf, np.float32)
+
+    def _weight(self, now):
+        return math.exp((now - self.origin) * self.rate)
+
+    # records damage to pixels
+    def hit(self, xs, ys, now=None):
+        now = time.monotonic() if now is None else now
+        weight = self._weight(now)
+        if weight > 1e30:
+            self.heat *= np.float32(1 / weight)
+            self.origin, weight = now, 1
+        np.add.at(self.heat, (ys, xs), weight)
+        self.last_hit[ys, xs] = now - self.start
+
+    # how much damage the pixels have taken, a hit counts as 1 when it's new
+    def value(self, xs, ys, now=None):
+        now = time.monotonic() if now is None else now
+        return self.heat[ys, xs] / self._weight(now)
+
+    # 1 for pixels damaged just now, going down to 0 for the ones damaged long ago (or never)
+    def recency(self, xs, ys, now=None):
+        now = time.monotonic() if now is None else now
+        return np.exp((self.last_hit[ys, xs] - (now - self.start)) / RECENCY_TIME)
+
+# an image being drawn at some position
+class Job:
+    def __init__(self, store, img, draw_x, draw_y, defend, strategy, priority=0):
+        global me
+        canv_id = store.d
+        self.store = store
+        self.canv_id = canv_id
+        self.img = img
+        self.draw_x = draw_x
+        self.draw_y = draw_y
+        self.defend = defend
+        self.strategy = strategy
+        self.priority = priority
+        self.keys = color_keys(me['canvases'][str(canv_id)]['colors'])
+        # pixels the server won't let us place
+        self.skipped = np.zeros(img.shape, bool)
+        # pixels this job draws (not transparent and not taken by another job)
+        self.owned = img != 255
+        # damage done to the image, kept when defending
+        self.heat = HeatMap(img.shape) if defend else None
+        self._importance = None
+
+    # how much the pixels matter for recognizing the image (computed when first needed)
+    @property
+    def importance(self):
+        if self._importance is None:
+            self._importance = pixel_importance(self.img, me['canvases'][str(self.canv_id)]['colors'])
+        return self._importance
+
+    # how urgent repairing the pixels is, combines how much they matter for the image
+    #  with how recently and how much they have been damaged
+    def repair_priority(self, xs, ys, now=None):
+        score = DEFEND_WEIGHTS['importance'] * self.importance[ys, xs]
+        if self.heat is not None:
+            heat = self.heat.value(xs, ys, now)
+            score = score + DEFEND_WEIGHTS['recency'] * self.heat.recency(xs, ys, now) + \
+                    DEFEND_WEIGHTS['heat'] * heat / (1 + heat)
+        return score
+
+    # leaves the pixels where the other job's image overlaps this one to the other job
+    def yield_to(self, other):
+        h, w = self.img.shape
+        o_h, o_w = other.img.shape
+        x0, x1 = max(self.draw_x, other.draw_x), min(self.draw_x + w, other.draw_x + o_w)
+        y0, y1 = max(self.draw_y, other.draw_y), min(self.draw_y + h, other.draw_y + o_h)
+        if x0 >= x1 or y0 >= y1:
+            return
+        theirs = other.img[y0 - other.draw_y:y1 - other.draw_y, x0 - other.draw_x:x1 - other.draw_x] != 255
+        self.owned[y0 - self.draw_y:y1 - self.draw_y, x0 - self.draw_x:x1 - self.draw_x] &= ~theirs
+
+    # checks if a template pixel differs from the canvas
+    def wrong(self, x, y):
+        return self.owned[y, x] and not self.skipped[y, x] and \
+            self.keys[self.store.get_pixel(x + self.draw_x, y + self.draw_y)] != self.keys[self.img[y, x]]
+
+    # finds all template pixels that differ from the canvas
+    def mismatch(self):
+        h, w = self.img.shape
+        return template_mismatch(self.store.region(self.draw_x, self.draw_y, w, h), self.img, self.keys) & self.owned & ~self.skipped
+
+    # places a template pixel using a session, returns the same as place_and_confirm()
+    async def place(self, client, x, y):
+        result = await place_and_confirm(client, self.canv_id, x + self.draw_x, y + self.draw_y, self.img[y, x])
+        if result == 'placed':
+            # the server has accepted it, no need to wait for the pixel update
+            self.store.set_pixel(x + self.draw_x, y + self.draw_y, self.img[y, x])
+        elif result == 'skip':
+            self.skipped[y, x] = True
+        return result
+
+# the placement plans of several jobs one after another, yields (job, x, y)
+class JobPlan:
+    def __init__(self, plans):
+        self.plans = plans
+        self.total = sum(len(plan) for _, plan in plans)
+        self.n = 0
+
+    def __len__(self):
+        return self.total
+
+    @property
+    def remaining(self):
+        return sum(plan.remaining for _, plan in self.plans[self.n:])
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while self.n < len(self.plans):
+            job, plan = self.plans[self.n]
+            pixel = next(plan, None)
+            if pixel is not None:
+                return (job,) + pixel
+            self.n += 1
+        raise StopIteration
+
+# several images drawn by the same sessions, maybe on different canvases
+# the ones with a higher priority are drawn and repaired first, and where images
+#  on the same canvas overlap, the one with the higher priority (or listed first) gets the pixels
+class JobManager:
+    def __init__(self, jobs):
+        # sorted() is stable, so the order they're listed in breaks ties
+        self.jobs = sorted(jobs, key=lambda job: -job.priority)
+        for n, job in enumerate(self.jobs):
+            for other in self.jobs[:n]:
+                if other.canv_id == job.canv_id:
+                    job.yield_to(other)
+        # jobs of the same priority are grouped by canvas, so the sessions switch canvases less often
+        self.order = sorted(self.jobs, key=lambda job: (-job.priority, job.canv_id))
+        self.rank = {job: n for n, job in enumerate(self.order)}
+        # chunk stores by canvas
+        self.stores = {job.canv_id: job.store for job in self.jobs}
+
+    def on_canvas(self, d):
+        return [job for job in self.jobs if job.canv_id == d]
+
+    # plans placing every pixel that's wrong
+    def plan(self):
+        return JobPlan([(job, PlacementPlan(plan_order(job.img, job.strategy, job.mismatch()), job.img.shape[1]))
+                        for job in self.order])
+
+    # finds the pixels that are wrong, as a list of (job, xs, ys)
+    def wrong_pixels(self, jobs):
+        return [(job,) + np.nonzero(job.mismatch())[::-1] for job in jobs]
+
+# pixels of a job pushed to a RepairQueue together, sorted from the most urgent
+RepairRun = collections.namedtuple('RepairRun', 'job xs ys scores')
+
+# template pixels waiting to be repaired, yields the most urgent (job, x, y) first
+# pixels are ordered by the priority of their job, and then by Job.repair_priority()
+#  (or row by row if DEFEND_ORDER is 'raster')
+# damage reported while the queue is being worked through is added to it on the way
+# (every push is scored and sorted with NumPy into a run, and the runs are merged lazily
+#  as pixels are taken, so a sweep finding a lot of wrong pixels doesn't hold up the event loop)
+class RepairQueue:
+    def __init__(self, manager, dirty=None):
+        self.manager = manager
+        self.dirty = dirty
+        # the next pixel of every run: (job rank, -priority, y, x, sequence number, position, run)
+        self.heap = []
+        # pixels in the queue by job
+        self.queued = {}
+        self.size = 0
+        self.seq = 0
+
+    def __len__(self):
+        return self.size
+
+    def _push_next(self, rank, run, pos):
+        heapq.heappush(self.heap, (rank, -float(run.scores[pos]), int(run.ys[pos]), int(run.xs[pos]), self.seq, pos, run))
+        self.seq += 1
+
+    # adds pixels from a list of (job, xs, ys)
+    def push(self, pixels):
+        now = time.monotonic()
+        for job, xs, ys in pixels:
+            if job not in self.queued:
+                self.queued[job] = np.zeros(job.img.shape, bool)
+            queued = self.queued[job]
+            # leave out repeated ones and the ones that are already queued
+            # (going through a mask also puts them in raster order)
+            new = np.zeros(job.img.shape, bool)
+            new[ys, xs] = True
+            new &= ~queued
+            queued |= new
+            ys, xs = np.nonzero(new)
+            if not len(xs):
+                continue
+            if DEFEND_ORDER == 'raster':
+                run = RepairRun(job, xs, ys, np.zeros(len(xs)))
             else:
-                succ = True
+                scores = np.asarray(job.repair_priority(xs, ys, now), np.float64)
+                # a stable sort keeps pixels of the same priority in raster order
+                order = np.argsort(-scores, kind='stable')
+                run = RepairRun(job, xs[order], ys[order], scores[order])
+            self._push_next(self.manager.rank[job], run, 0)
+            self.size += len(xs)
+        metrics.set('ppfun2_repair_queue_depth', self.size)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.dirty is not None:
+            self.push(self.dirty.take())
+        if not self.heap:
+            raise StopIteration
+        rank, _, y, x, _, pos, run = heapq.heappop(self.heap)
+        if pos + 1 < len(run.xs):
+            self._push_next(rank, run, pos + 1)
+        self.queued[run.job][y, x] = False
+        self.size -= 1
+        return run.job, x, y
+
+# places template pixels from an iterator of (job, x, y) using all sessions
+# whichever session's cooldown runs out first takes the next pixel,
+#  and pixels a session failed to place go back for the others to take
+# returns once every pixel is placed or skipped, without waiting for idle sessions
+async def place_pixels(clients, pixels, report):
+    clients = [client for client in clients if client.dropped is None]
+    if not clients:
+        raise PlacementError('none of the sessions can place pixels')
+    returned = collections.deque()
+    drained = False
+    holding = 0
+    active = len(clients)
+    cond = asyncio.Condition()
+
+    def finished():
+        return drained and not returned and holding == 0
+
+    async def worker(client):
+        global pixels_drawn
+        nonlocal drained, holding, active
+        while True:
+            await client.scheduler.wait()
+            async with cond:
+                # a busy session might still give its pixel back
+                await cond.wait_for(lambda: returned or not drained or finished())
+                if returned:
+                    pixel = returned.popleft()
+                elif not drained:
+                    pixel = next(pixels, None)
+                    drained = pixel is None
+                else:
+                    return
+                if pixel is None:
+                    cond.notify_all()
+                    continue
+                holding += 1
+            job, x, y = pixel
+            result = None
+            try:
+                if job.wrong(x, y):
+                    if client.canvas != job.canv_id:
+                        client.select(job.store)
+                        await client.scheduler.wait()
+                    report(job, x, y)
+                    result = await job.place(client, x, y)
+            finally:
+                async with cond:
+                    holding -= 1
+                    if result in ('retry', 'drop'):
+                        returned.append(pixel)
+                    if result == 'drop':
+                        active -= 1
+                    cond.notify_all()
+            if result == 'placed':
+                pixels_drawn += 1
+            elif result == 'drop':
+                # the other sessions carry on, unless there are none left
+                if active == 0:
+                    raise PlacementError(client.dropped)
+                return
+
+    async def wait_finished():
+        async with cond:
+            await cond.wait_for(finished)
+
+    monitor = asyncio.create_task(wait_finished())
+    tasks = [asyncio.create_task(worker(client)) for client in clients] + [monitor]
+    try:
+        pending = set(tasks)
+        while monitor in pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+# draws the images
+async def draw_function(clients, manager):
+    global pixels_drawn, start_time
+    start_time = datetime.datetime.now()
+
+    # only plan the pixels that are actually wrong, and check again when done
+    #  in case something has changed while we were drawing
+    while True:
+        plan = manager.plan()
+        if len(plan) == 0:
+            break
+        print(f'{Fore.YELLOW}Pixels to place: {Fore.GREEN}{len(plan)}{Style.RESET_ALL}')
+
+        def report(job, x, y):
+            pixels_remaining = plan.remaining + 1
+            sec_per_px = (datetime.datetime.now() - start_time).total_seconds() / pixels_drawn
+            time_remaining = datetime.timedelta(seconds=(pixels_remaining * sec_per_px))
+            logger.log(f'{Fore.YELLOW}Placing a pixel at {Fore.GREEN}({x + job.draw_x}, {y + job.draw_y})' + 
+                f'{Fore.YELLOW}, progress: {Fore.GREEN}{"{:2.4f}".format((len(plan) - pixels_remaining) * 100 / len(plan))}%' +
+                f'{Fore.YELLOW}, remaining: {Fore.GREEN}{"estimating" if pixels_drawn < 20 else str(time_remaining)}' +
+                f'{Fore.YELLOW}, {Fore.GREEN}{pixels_drawn}{Fore.YELLOW} pixels placed{Style.RESET_ALL}', event='place')
+
+        await place_pixels(clients, plan, report)
 
     print(f'{Fore.GREEN}Done drawing{Style.RESET_ALL}')
-    if not defend:
+    defended = [job for job in manager.jobs if job.defend]
+    if not defended:
         return
     print(f'{Fore.GREEN}Entering defend mode{Style.RESET_ALL}')
+    queue = RepairQueue(manager, dirty_pixels)
+    # waiting for changed pixels takes a thread for up to DEFEND_SWEEP_INTERVAL,
+    #  better not one of the default executor
+    waiter = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='Defend')
+
+    def report_defend(job, x, y):
+        logger.log(f'{Fore.YELLOW}[DEFENDING] Placing a pixel at {Fore.GREEN}({x + job.draw_x}, {y + job.draw_y}){Style.RESET_ALL}', event='defend')
+
+    # repair the pixels the receiving code reports as changed (the most urgent first),
+    #  and recheck the whole image every once in a while in case something was missed
+    last_sweep = 0
+    try:
+        while True:
+            until_sweep = last_sweep + DEFEND_SWEEP_INTERVAL - time.time()
+            if until_sweep <= 0:
+                queue.push(manager.wrong_pixels(defended))
+                last_sweep = time.time()
+            else:
+                try:
+                    queue.push(await asyncio.get_running_loop().run_in_executor(waiter, dirty_pixels.take, until_sweep))
+                except asyncio.CancelledError:
+                    # don't leave the thread waiting
+                    dirty_pixels.wake()
+                    raise
+            await place_pixels(clients, queue, report_defend)
+    finally:
+        waiter.shutdown(wait=False)
+
+# logs into an account, returns the WebSocket headers for it or None
+def log_in(login, passwd):
+    response = requests.post(f'{PPFUN_URL}/api/auth/local', json={'nameoremail':login, 'password':passwd})
+    resp_js = response.json()
+    if 'success' in resp_js and resp_js['success']:
+        print(f'{Fore.YELLOW}Logged in as {Fore.GREEN}{resp_js["me"]["name"]}{Style.RESET_ALL}')
+        # get the token and add it as a WebSocket cookie
+        auth_token = response.cookies.get('pixelplanet.session')
+        return ["Cookie: pixelplanet.session=" + auth_token]
+    print(f'{Fore.RED}Authorization failed for {login}{Style.RESET_ALL}')
+    return None
+
+# loads additional sessions from a JSON file that lists accounts like this:
+# [{"login": "name or e-mail", "password": "...", "proxy": "host:port"}, ...]
+# (login and proxy can be left out)
+def load_sessions(file):
+    with open(file) as f:
+        accounts = json.load(f)
+    sessions = []
+    for account in accounts:
+        headers = []
+        if account.get('login'):
+            headers = log_in(account['login'], account.get('password', ''))
+            if headers is None:
+                continue
+        proxy_host, proxy_port = None, None
+        if account.get('proxy'):
+            proxy_host, proxy_port = account['proxy'].split(':')
+            proxy_port = int(proxy_port)
+        sessions.append((headers, proxy_host, proxy_port))
+    return sessions
+
+# pixel update packets waiting to be written into the chunk data
+# the reader only queues them, apply_updates() writes them in batches
+class UpdateQueue:
+    def __init__(self):
+        # (time.monotonic() when received, canvas, packet)
+        self.packets = collections.deque()
+        self.event = asyncio.Event()
+        self.applied = 0
+        self.dropped = 0
+
+    def put(self, canvas, data):
+        self.packets.append((time.monotonic(), canvas, data))
+        self.event.set()
+
+    # number of queued packets
+    @property
+    def depth(self):
+        return len(self.packets)
+
+    # how long the oldest queued packet has been waiting, in seconds
+    @property
+    def lag(self):
+        return time.monotonic() - self.packets[0][0] if self.packets else 0
+
+    # waits for packets and takes all of them
+    # returns {canvas: [packets]} and the lag
+    async def take(self):
+        await self.event.wait()
+        self.event.clear()
+        lag = self.lag
+        batches = collections.defaultdict(list)
+        for _, canvas, data in self.packets:
+            batches[canvas].append(data)
+        self.packets.clear()
+        return batches, lag
+
+# print a warning when pixel updates wait longer than this, in seconds
+UPDATE_LAG_WARNING = 0.5
+
+# indices of the last change of every pixel, if a pixel changed several times
+def last_changes(geometry, xs, ys):
+    _, last = np.unique(((ys + geometry.half) * geometry.size + xs)[::-1], return_index=True)
+    return len(xs) - 1 - last
 
-    # do the same thing, but now in a loop that checks everything once per second
+# the pixel log format version
+PIXEL_LOG_VERSION = 1
+# how often the pixel log saves the whole state of the loaded chunks, in seconds
+PIXEL_LOG_CHECKPOINT_INTERVAL = 10 * 60
+# a pixel log record, 8 bytes:
+#  a pixel change: canvas, chunk, offset in the chunk, color and ms since the previous record
+#  a time mark (canvas is 0xFF): ms since the epoch in the other 7 bytes, the following records count from it
+PIXEL_LOG_RECORD = np.dtype([('d', 'u1'), ('i', 'u1'), ('j', 'u1'), ('offs', '>u2'), ('clr', 'u1'), ('dt', '>u2')])
+PIXEL_LOG_TIME_MARK = 0xFF
+# the longest time between records that doesn't need a time mark, in ms
+PIXEL_LOG_MAX_DT = 0xFFFF
+
+class PixelLogError(Exception):
+    pass
+
+# opens the metadata of a pixel log directory, creating it if needed
+def pixel_log_meta(log_dir, create=False):
+    meta_path = path.join(log_dir, 'meta.json')
+    if not path.exists(meta_path):
+        if not create:
+            raise PixelLogError(f'{log_dir} is not a pixel log')
+        return {'version': PIXEL_LOG_VERSION, 'sizes': {}}
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta.get('version') != PIXEL_LOG_VERSION:
+        raise PixelLogError(f'{log_dir} is a pixel log of another version')
+    return meta
+
+# writes every pixel update received in the loaded chunks to an append-only log directory:
+#  meta.json      format version and sizes of the canvases
+#  pixels.log     PIXEL_LOG_RECORD records
+#  checkpoints/   the loaded chunks every PIXEL_LOG_CHECKPOINT_INTERVAL seconds,
+#                 named after the number of records written before them
+class PixelRecorder:
+    def __init__(self, log_dir, stores, checkpoint_interval=PIXEL_LOG_CHECKPOINT_INTERVAL):
+        self.dir = log_dir
+        self.stores = stores
+        self.interval = checkpoint_interval * 1000
+        meta = pixel_log_meta(log_dir, create=True)
+        for d in stores:
+            meta['sizes'][str(d)] = canvas_geometry(d).size
+        os.makedirs(path.join(log_dir, 'checkpoints'), exist_ok=True)
+        write_file(path.join(log_dir, 'meta.json'), json.dumps(meta).encode())
+        self.file = open(path.join(log_dir, 'pixels.log'), 'ab')
+        # drop a record cut in half by a crash
+        self.file.truncate(self.file.tell() - self.file.tell() % PIXEL_LOG_RECORD.itemsize)
+        self.records = self.file.tell() // PIXEL_LOG_RECORD.itemsize
+        # ms since the epoch of the last record, None to start with a time mark
+        self.last_ms = None
+        self.last_checkpoint = None
+
+    # saves the loaded chunks, the ones loaded later are only in the next checkpoint
+    def checkpoint(self, now_ms):
+        arrays = {f'{d}.{i}.{j}': tile for d, store in self.stores.items() for (i, j), tile in store.tiles.items()}
+        name = path.join(self.dir, 'checkpoints', f'{self.records}.npz')
+        write_file(name, functools.partial(np.savez_compressed, time=np.int64(now_ms), **arrays))
+        self.last_checkpoint = now_ms
+
+    # logs pixel updates from the packets of one canvas (before they are written into its chunk store)
+    def record(self, d, i, j, offs, clr, now=None):
+        if not len(i):
+            return
+        now_ms = int((time.time() if now is None else now) * 1000)
+        if self.last_checkpoint is None or now_ms - self.last_checkpoint >= self.interval:
+            self.checkpoint(now_ms)
+        arr = np.zeros(len(i) + 1, PIXEL_LOG_RECORD)
+        if self.last_ms is None or not 0 <= now_ms - self.last_ms <= PIXEL_LOG_MAX_DT:
+            arr.view(np.uint8).reshape(-1, 8)[0] = np.frombuffer(now_ms.to_bytes(8, 'big'), np.uint8)
+            arr[0]['d'] = PIXEL_LOG_TIME_MARK
+            self.last_ms = now_ms
+        else:
+            arr = arr[1:]
+        changes = arr[-len(i):]
+        changes['d'], changes['i'], changes['j'], changes['offs'], changes['clr'] = d, i, j, offs, clr
+        changes['dt'][0] = now_ms - self.last_ms
+        self.last_ms = now_ms
+        self.file.write(arr.tobytes())
+        self.file.flush()
+        self.records += len(arr)
+
+    def close(self):
+        self.file.close()
+
+# reads a pixel log written by PixelRecorder
+# times are in seconds since the epoch, like time.time()
+class PixelLog:
+    def __init__(self, log_dir):
+        self.dir = log_dir
+        meta = pixel_log_meta(log_dir)
+        self.canvases = sorted(int(d) for d in meta['sizes'])
+        for d, size in meta['sizes'].items():
+            canvas_geometries.setdefault(int(d), CanvasGeometry(size))
+        log_path = path.join(log_dir, 'pixels.log')
+        count = path.getsize(log_path) // PIXEL_LOG_RECORD.itemsize if path.exists(log_path) else 0
+        self.records = np.memmap(log_path, PIXEL_LOG_RECORD, 'r', shape=(count,)) if count \
+                       else np.zeros(0, PIXEL_LOG_RECORD)
+        self.times = self._times()
+        # (number of records before, ms since the epoch, file)
+        self.checkpoints = []
+        for name in os.listdir(path.join(log_dir, 'checkpoints')):
+            if name.endswith('.npz'):
+                with np.load(path.join(log_dir, 'checkpoints', name)) as data:
+                    self.checkpoints.append((int(name[:-4]), int(data['time']), path.join(log_dir, 'checkpoints', name)))
+        self.checkpoints.sort()
+
+    # ms since the epoch of every record
+    def _times(self):
+        is_mark = self.records['d'] == PIXEL_LOG_TIME_MARK
+        raw = self.records.view(np.uint8).reshape(-1, 8)[is_mark]
+        mark_bytes = np.zeros((len(raw), 8), np.uint8)
+        mark_bytes[:, 1:] = raw[:, 1:]
+        mark_ms = mark_bytes.view('>u8').ravel().astype(np.int64)
+        elapsed = np.cumsum(np.where(is_mark, 0, self.records['dt']).astype(np.int64))
+        mark = np.cumsum(is_mark) - 1
+        return mark_ms[mark] + elapsed - elapsed[is_mark][mark]
+
+    # time of the first and the last record
+    @property
+    def start(self):
+        return self.times[0] / 1000 if len(self.times) else None
+
+    @property
+    def end(self):
+        return self.times[-1] / 1000 if len(self.times) else None
+
+    # number of records up to a time
+    def _count_until(self, t):
+        # (in case the clock went back while recording)
+        return int(np.searchsorted(np.maximum.accumulate(self.times), t * 1000, 'right'))
+
+    # pixel changes between two times, as arrays of time, canvas, x, y and color
+    def changes(self, t0=None, t1=None):
+        a = 0 if t0 is None else self._count_until(t0 - 0.001)
+        b = len(self.records) if t1 is None else self._count_until(t1)
+        records, times = self.records[a:b], self.times[a:b]
+        keep = records['d'] != PIXEL_LOG_TIME_MARK
+        records, times = records[keep], times[keep]
+        xs, ys = np.zeros(len(records), np.int64), np.zeros(len(records), np.int64)
+        for d in np.unique(records['d']).tolist():
+            on_canvas = records['d'] == d
+            xs[on_canvas], ys[on_canvas] = canvas_geometry(d).from_packet(
+                records['i'][on_canvas].astype(np.int64), records['j'][on_canvas].astype(np.int64),
+                records['offs'][on_canvas].astype(np.int64))
+        return times / 1000, records['d'], xs, ys, records['clr']
+
+    # the logged chunks as they were at a time, as {canvas: ChunkStore}
+    # starts from the last checkpoint before that time, chunks loaded after it start out as 0
+    def state_at(self, t):
+        n = self._count_until(t)
+        stores = {d: ChunkStore(d) for d in self.canvases}
+        start = 0
+        usable = [c for c in self.checkpoints if c[0] <= n and c[1] <= t * 1000]
+        if usable:
+            start, _, file = usable[-1]
+            with np.load(file) as data:
+                for key in data.files:
+                    if key != 'time':
+                        d, i, j = map(int, key.split('.'))
+                        stores.setdefault(d, ChunkStore(d)).tiles[i, j] = data[key]
+        records = self.records[start:n]
+        records = records[records['d'] != PIXEL_LOG_TIME_MARK]
+        for d in np.unique(records['d']).tolist():
+            changes = records[records['d'] == d]
+            store = stores.setdefault(d, ChunkStore(d))
+            for i, j in set(zip(changes['i'].tolist(), changes['j'].tolist())) - set(store.tiles):
+                store.tiles[i, j] = np.zeros((256, 256), np.uint8)
+            geometry = canvas_geometry(d)
+            xs, ys = geometry.from_packet(changes['i'].astype(np.int64), changes['j'].astype(np.int64),
+                                          changes['offs'].astype(np.int64))
+            keep = last_changes(geometry, xs, ys)
+            store.set(xs[keep], ys[keep], changes['clr'][keep])
+        return stores
+
+    # a rectangle of a canvas as it was at a time
+    def area(self, d, x, y, w, h, t):
+        stores = self.state_at(t)
+        return stores[d].region(x, y, w, h) if d in stores else np.zeros((h, w), np.uint8)
+
+# writes queued pixel updates into the chunk stores, several at once
+# updates outside of the loaded chunks are dropped, the ones in defended images are reported to defend mode
+# and logged by the recorder if there's one
+async def apply_updates(updates, manager, recorder=None):
     while True:
-        for y in range(size[0]):
-            for x in range(size[1]):
-                if img[y, x] == 255:
-                    continue
-                if canv_clr[chunk_data[start_in_d_y + y, start_in_d_x + x]] != canv_clr[img[y, x]]:
-                    print(f'{Fore.YELLOW}[DEFENDING] Placing a pixel at {Fore.GREEN}({x + draw_x}, {y + draw_y}){Style.RESET_ALL}')
-                    # get the color index
-                    c_idx = img[y, x]
-                    # try to draw it
-                    while not draw:
-                        time.sleep(0.25)
-                        pass
-                    draw = False
-                    place_pixel(ws, canv_id, x + draw_x, y + draw_y, c_idx)
-                    # this flag will be reset when the other thread receives a confirmation message
-                    while not draw:
-                        time.sleep(0.25)
-                        pass
-                    # wait half a second
-                    # (a little bit of artifical fluctuation
-                    #  so the server doesn't think we're a bot)
-                    time.sleep(0.5 + random.uniform(-0.25, 0.25))
-        time.sleep(1)
+        batches, lag = await updates.take()
+        count = sum(len(packets) for packets in batches.values())
+        if lag > UPDATE_LAG_WARNING:
+            logger.log(f'{Fore.RED}Pixel updates are falling behind: {Fore.GREEN}{updates.depth + count}{Fore.RED} queued, ' +
+                       f'{Fore.GREEN}{int(lag * 1000)}{Fore.RED} ms lag{Style.RESET_ALL}', WARNING, 'lag')
+        in_images = 0
+        for d, packets in batches.items():
+            if d not in manager.stores:
+                updates.dropped += len(packets)
+                continue
+            geometry = canvas_geometry(d)
+            i, j, offs, clr = decode_pixel_updates(packets)
+            if recorder is not None:
+                recorder.record(d, i, j, offs, clr)
+            xs, ys = geometry.from_packet(i.astype(np.int64), j.astype(np.int64), offs)
+            # if a pixel changed several times, only the last change counts
+            keep = last_changes(geometry, xs, ys)
+            xs, ys, clr = xs[keep], ys[keep], clr[keep]
+            written = manager.stores[d].set(xs, ys, clr)
+            updates.dropped += len(keep) - int(written.sum())
+            updates.applied += int(written.sum())
+            xs, ys, clr = xs[written], ys[written], clr[written]
+            # tell the defending code about the ones in the images
+            for job in manager.on_canvas(d):
+                t_height, t_width = job.img.shape
+                tx, ty = xs - job.draw_x, ys - job.draw_y
+                in_img = (tx >= 0) & (tx < t_width) & (ty >= 0) & (ty < t_height)
+                tx, ty, t_clr = tx[in_img], ty[in_img], clr[in_img]
+                owned = job.owned[ty, tx]
+                tx, ty, t_clr = tx[owned], ty[owned], t_clr[owned]
+                in_images += len(tx)
+                # the ones that made the image wrong
+                griefed = job.keys[t_clr] != job.keys[job.img[ty, tx]]
+                tx, ty = tx[griefed], ty[griefed]
+                metrics.inc('ppfun2_griefed_pixels_total', len(tx))
+                if job.defend and len(tx):
+                    job.heat.hit(tx, ty)
+                    dirty_pixels.add_many(job, tx, ty)
+        metrics.inc('ppfun2_pixel_updates_total', count)
+        logger.log(f'{Fore.YELLOW}Pixel updates: {Fore.GREEN}{count}{Fore.YELLOW} ' +
+                   f'({Fore.GREEN}{in_images}{Fore.YELLOW} in the images){Style.RESET_ALL}', event='updates', count=count)
+
+# updates the gauges and prints the log summaries, and every METRICS_INTERVAL seconds
+#  counts the wrong pixels and writes the metrics to a file (if there's one)
+async def export_metrics(clients, manager, updates, metrics_file=None):
+    last_write = 0
+    while True:
+        logger.flush()
+        metrics.set('ppfun2_update_queue_depth', updates.depth)
+        metrics.set('ppfun2_update_queue_lag_seconds', updates.lag)
+        metrics.set('ppfun2_sessions', len(clients))
+        if time.monotonic() - last_write >= METRICS_INTERVAL:
+            last_write = time.monotonic()
+            metrics.set('ppfun2_wrong_pixels', sum(int(job.mismatch().sum()) for job in manager.jobs))
+            if metrics_file is not None:
+                write_file(metrics_file, metrics.render().encode())
+        await asyncio.sleep(1)
+
+# runs a function in the event loop thread and returns its result
+# (cProfile only sees the thread it was enabled in)
+def call_in_loop(loop, fn):
+    async def call():
+        return fn()
+    return asyncio.run_coroutine_threadsafe(call(), loop).result(10)
+
+# turns cProfile and tracemalloc on and off while the bot is running
+class Profiler:
+    # how many lines of stats to return
+    TOP = 30
+
+    def __init__(self):
+        self.profile = None
+
+    def profile_start(self):
+        import cProfile
+        if self.profile is None:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        return 'profiling\n'
+
+    # stops profiling, saves the stats to ppfun2.prof and returns the slowest functions
+    def profile_stop(self):
+        import pstats, io
+        if self.profile is None:
+            return 'not profiling\n'
+        self.profile.disable()
+        self.profile.dump_stats('ppfun2.prof')
+        out = io.StringIO()
+        pstats.Stats(self.profile, stream=out).sort_stats('cumulative').print_stats(self.TOP)
+        self.profile = None
+        return out.getvalue()
+
+    def tracemalloc_start(self):
+        import tracemalloc
+        tracemalloc.start()
+        return 'tracing allocations\n'
+
+    def tracemalloc_snapshot(self):
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            return 'not tracing allocations\n'
+        stats = tracemalloc.take_snapshot().statistics('lineno')[:self.TOP]
+        return '\n'.join(str(stat) for stat in stats) + '\n'
+
+    def tracemalloc_stop(self):
+        import tracemalloc
+        tracemalloc.stop()
+        return 'stopped tracing allocations\n'
+
+# serves the metrics and debugging switches over HTTP on localhost:
+#  /metrics                                       the metrics in the Prometheus text format
+#  /debug/profile/start, /debug/profile/stop      cProfile
+#  /debug/tracemalloc/start, .../snapshot, .../stop
+#  /debug/loglevel/debug, .../info, ...           changes the log level
+# returns the server, call shutdown() on it to stop
+def serve_metrics(port, loop):
+    import http.server
+    profiler = Profiler()
+    routes = {
+        '/metrics':                  metrics.render,
+        '/debug/profile/start':      lambda: call_in_loop(loop, profiler.profile_start),
+        '/debug/profile/stop':       lambda: call_in_loop(loop, profiler.profile_stop),
+        '/debug/tracemalloc/start':  profiler.tracemalloc_start,
+        '/debug/tracemalloc/snapshot': profiler.tracemalloc_snapshot,
+        '/debug/tracemalloc/stop':   profiler.tracemalloc_stop,
+    }
+    for n, name in enumerate(LOG_LEVELS):
+        def set_level(level=n, name=name):
+            logger.level = level
+            return f'log level: {name}\n'
+        routes[f'/debug/loglevel/{name}'] = set_level
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            route = routes.get(self.path.split('?')[0])
+            if route is None:
+                self.send_error(404)
+                return
+            body = route().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # keep requests out of the bot's output
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# connects to the server, draws the images of the jobs and keeps their chunk stores up to date
+# sessions is a list of (WebSocket headers, proxy host, proxy port), the first one
+#  also receives pixel updates for the whole pool (or watches the canvases, if there are several)
+# metrics_export is a port to serve the metrics on, a file to write them to or None
+# recorder is a PixelRecorder to log the pixel updates with or None
+async def run_bot(sessions, jobs, metrics_export=None, recorder=None):
+    global me, dirty_pixels
+    manager = JobManager(jobs)
+    dirty_pixels = DirtySet()
+
+    def on_chat(msg):
+        print(f'{Fore.GREEN}{msg.name}{Fore.YELLOW} (country: {Fore.GREEN}{msg.country}{Fore.YELLOW}) ' + 
+                f'says: {Fore.GREEN}{msg.text}{Fore.YELLOW} in chat {Fore.GREEN}{"int" if msg.country == 0 else "en"}{Style.RESET_ALL}')
+
+    def on_online_counter(packet):
+        logger.log(f'{Fore.YELLOW}Online counter: {Fore.GREEN}{packet.online}{Style.RESET_ALL}', event='online')
+
+    def on_unknown(packet):
+        logger.log(f'{Fore.RED}Unreconized data opcode from the server. Raw data: {packet.data}{Style.RESET_ALL}', WARNING, 'unknown')
+
+    handlers = {
+        ChatMessage:   on_chat,
+        OnlineCounter: on_online_counter,
+        UnknownPacket: on_unknown,
+    }
+
+    # the other sessions only need to place pixels
+    def ignore_message(data):
+        pass
+
+    # handles server messages (except the ones about cooldown and pixel updates,
+    #  they are handled elsewhere)
+    def on_message(packet):
+        handlers.get(type(packet), ignore_message)(packet)
+
+    clients = [Client(on_message if n == 0 else ignore_message, *session) for n, session in enumerate(sessions)]
+    # the server only sends pixel updates for the selected canvas, so with images on several
+    #  canvases (where the sessions switch between them) every canvas gets a connection of its own
+    #  that only watches it, otherwise the first session receives them
+    updates = UpdateQueue()
+    watchers = [Client(ignore_message, *sessions[0]) for _ in manager.stores] if len(manager.stores) > 1 else []
+    print(f'{Fore.YELLOW}Connecting {Fore.GREEN}{len(clients)}{Fore.YELLOW} session(s){Style.RESET_ALL}')
+    await asyncio.gather(*(client.connect() for client in clients + watchers))
+    for watcher, store in zip(watchers, manager.stores.values()):
+        watcher.updates = updates
+        watcher.select(store)
+    if not watchers:
+        clients[0].updates = updates
+    # start on the canvas of the most important image
+    for client in clients:
+        client.select(manager.order[0].store)
+    server = None
+    if type(metrics_export) == int:
+        server = serve_metrics(metrics_export, asyncio.get_running_loop())
+        logger.log(f'{Fore.YELLOW}Serving metrics at {Fore.GREEN}http://127.0.0.1:{metrics_export}/metrics{Style.RESET_ALL}')
+    try:
+        # draw until done (or forever if defending)
+        await run_sessions(clients + watchers, draw_function(clients, manager),
+                           [apply_updates(updates, manager, recorder),
+                            export_metrics(clients, manager, updates, metrics_export if type(metrics_export) == str else None)])
+    finally:
+        if server is not None:
+            server.shutdown()
+        if recorder is not None:
+            recorder.close()
+
+# how long the canvas list from /api/me is cached, in seconds
+ME_CACHE_TTL = 6 * 60 * 60
+
+# gets the canvas list, from the cache if it's recent enough
+# (the cache is only refreshed after ME_CACHE_TTL, or if it was made for another server)
+def get_me(cache_dir=CACHE_DIR, ttl=ME_CACHE_TTL):
+    cache_file = path.join(cache_dir, 'me.json') if cache_dir is not None else None
+    cached = None
+    if cache_file is not None and path.exists(cache_file):
+        try:
+            with open(cache_file) as f:
+                cached = json.load(f)
+            cached['me']['canvases']
+        except (OSError, ValueError, TypeError, KeyError):
+            # a broken cache is as good as none
+            cached = None
+        if cached is not None and cached.get('url') == PPFUN_URL and time.time() - path.getmtime(cache_file) < ttl:
+            return cached['me']
+    print(f'{Fore.YELLOW}Requesting initial data{Style.RESET_ALL}')
+    try:
+        me = requests.get(f'{PPFUN_URL}/api/me', timeout=10).json()
+    except requests.RequestException:
+        # an outdated list is better than none
+        if cached is not None and cached.get('url') == PPFUN_URL:
+            print(f'{Fore.RED}Couldn\'t request initial data, using the cached one{Style.RESET_ALL}')
+            return cached['me']
+        raise
+    if cache_file is not None:
+        write_file(cache_file, json.dumps({'url': PPFUN_URL, 'me': me}).encode())
+    return me
+
+# points the bot at another server (e.g. a copy of PixelPlanet or ppsim.py), given by its HTTP URL
+def set_server(url):
+    global PPFUN_URL, PPFUN_WS_URL
+    PPFUN_URL = url.rstrip('/')
+    PPFUN_WS_URL = ('wss://' + PPFUN_URL[8:] if PPFUN_URL.startswith('https://') else
+                    'ws://' + PPFUN_URL[7:] if PPFUN_URL.startswith('http://') else PPFUN_URL) + '/ws'
+
+# checks for a new version and downloads it, runs in the background
+#  so the bot doesn't have to wait for GitHub (the new version is used on the next start)
+def check_for_updates():
+    try:
+        server_verdef = requests.get(VERDEF_URL, timeout=10).text
+        if int(server_verdef.split('\n')[1]) <= VERSION_NUM:
+            return
+        server_ver = server_verdef.split('\n')[0]
+        logger.log(f'{Fore.YELLOW}There\'s a new version {Fore.GREEN}{server_ver}{Fore.YELLOW} on the server. Downloading{Style.RESET_ALL}')
+        content = requests.get(BOT_URL, timeout=30).content
+        write_file('ppfun2.py', content)
+        logger.log(f'{Fore.YELLOW}Downloaded version {Fore.GREEN}{server_ver}{Fore.YELLOW}, restart the bot to use it{Style.RESET_ALL}')
+    except (requests.RequestException, ValueError, IndexError, OSError) as e:
+        logger.log(f'{Fore.RED}Couldn\'t check for updates: {e}{Style.RESET_ALL}', WARNING)
+
+# job options that can be left out when the bot runs non-interactively
+JOB_DEFAULTS = {
+    'login':        None,
+    'password':     None,
+    'proxy':        None,
+    'accounts':     None,
+    'defend':       False,
+    'strategy':     'forward',
+    'metric':       'rgb',
+    'dither':       'none',
+    'preview':      False,
+    'show_area':    'n',
+    'metrics':      None,
+    'log_level':    'info',
+    'chunk_memmap': None,
+    'pixel_log':    None,
+    'update_check': True,
+    'server':       None,
+}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='PixelPlanet bot. Options that are not given are asked for, ' +
+                                     'unless there\'s a job file or --yes',
+                                     argument_default=argparse.SUPPRESS)
+    parser.add_argument('job', nargs='?', help='TOML or JSON file with the job options, the command line overrides them')
+    parser.add_argument('--image', help='path to the image')
+    parser.add_argument('--x', type=int, help='X coordinate of the top-left corner')
+    parser.add_argument('--y', type=int, help='Y coordinate of the top-left corner')
+    parser.add_argument('--canvas', help='canvas ID')
+    parser.add_argument('--defend', action=argparse.BooleanOptionalAction)
+    parser.add_argument('--strategy', choices=STRATEGIES)
+    parser.add_argument('--metric', choices=COLOR_METRICS)
+    parser.add_argument('--dither', choices=DITHER_MODES)
+    parser.add_argument('--login', help='username or e-mail (the password is taken from PPFUN2_PASSWORD or asked for)')
+    parser.add_argument('--proxy', help='host:port')
+    parser.add_argument('--accounts', help='JSON file with more accounts to draw with')
+    parser.add_argument('--preview', action=argparse.BooleanOptionalAction, help='show the converted image')
+    parser.add_argument('--show-area', dest='show_area', choices=['y', 'n', 'overlay'], help='show the area around the destination')
+    parser.add_argument('--metrics', help='port to serve the metrics on or file to write them to')
+    parser.add_argument('--log-level', dest='log_level', choices=LOG_LEVELS)
+    parser.add_argument('--chunk-memmap', dest='chunk_memmap', help='keep the chunks in files in this directory instead of in memory')
+    parser.add_argument('--pixel-log', dest='pixel_log', help='directory to log all pixel updates in the chunks to')
+    parser.add_argument('--update-check', dest='update_check', action=argparse.BooleanOptionalAction)
+    parser.add_argument('--server', help=f'URL of the server to draw on (default: {PPFUN_URL})')
+    parser.add_argument('-y', '--yes', action='store_true', help='don\'t ask for anything, use the defaults')
+    return vars(parser.parse_args(argv))
+
+# loads job options from a TOML or JSON file, with the same names as the command line options
+def load_job(file):
+    if path.splitext(file)[1].lower() == '.toml':
+        try:
+            import tomllib
+        except ImportError:
+            print(f'{Fore.RED}Reading TOML needs Python 3.11 or newer, use a JSON job file instead{Style.RESET_ALL}')
+            exit()
+        with open(file, 'rb') as f:
+            job = tomllib.load(f)
+    else:
+        with open(file) as f:
+            job = json.load(f)
+    return {key.replace('-', '_'): value for key, value in job.items()}
 
 def main():
-    global me, draw, succ, chunk_data
+    global me
     # initialize colorama
     init()
 
-    # get the version on the server
-    print(f'{Fore.YELLOW}PixelPlanet bot by portasynthinca3 version {Fore.GREEN}{VERSION}{Fore.YELLOW}\nChecking for updates{Style.RESET_ALL}')
-    server_verdef = requests.get(VERDEF_URL).text
-    if int(server_verdef.split('\n')[1]) > VERSION_NUM:
-        # update
-        server_ver = server_verdef.split('\n')[0]
-        print(f'{Fore.YELLOW}There\'s a new version {Fore.GREEN}{server_ver}{Fore.YELLOW} on the server. Downloading{Style.RESET_ALL}')
-        with open('ppfun2.py', 'wb') as bot_file:
-            bot_file.write(requests.get(BOT_URL).content)
-        print(f'{Fore.YELLOW}Please start the bot again{Style.RESET_ALL}')
-        exit()
-    else:
-        print(f'{Fore.YELLOW}You\'re running the latest version{Style.RESET_ALL}')
+    job = parse_args()
+    job_file = job.pop('job', None)
+    interactive = job_file is None and not job.pop('yes', False)
+    if job_file is not None:
+        job = {**load_job(job_file), **job}
+
+    # takes an option from the job, or asks for it
+    def option(name, ask, choices=None):
+        if name in job:
+            value = job[name]
+            if choices is not None and value not in choices:
+                print(f'{Fore.RED}{name} must be one of: {", ".join(choices)}{Style.RESET_ALL}')
+                exit()
+            return value
+        if not interactive:
+            if name in JOB_DEFAULTS:
+                return JOB_DEFAULTS[name]
+            print(f'{Fore.RED}{name} is required{Style.RESET_ALL}')
+            exit()
+        return ask()
+
+    logger.level = LOG_LEVELS.index(option('log_level', lambda: JOB_DEFAULTS['log_level'], LOG_LEVELS))
+
+    print(f'{Fore.YELLOW}PixelPlanet bot by portasynthinca3 version {Fore.GREEN}{VERSION}{Style.RESET_ALL}')
+    if option('update_check', lambda: JOB_DEFAULTS['update_check']):
+        threading.Thread(target=check_for_updates, daemon=True).start()
+
+    server = option('server', lambda: JOB_DEFAULTS['server'])
+    if server is not None:
+        set_server(server)
 
     # get canvas info list and user identifier
-    print(f'{Fore.YELLOW}Requesting initial data{Style.RESET_ALL}')
-    me = requests.get('https://pixelplanet.fun/api/me').json()
+    me = get_me()
+    chunk_loader.prune()
 
     # authorize
-    print(f'{Fore.YELLOW}Enter your PixelPlanet username or e-mail (leave empty to skip authorization): {Style.RESET_ALL}', end='')
-    login = input()
-    passwd = ''
-    auth_token = ''
+    def ask_login():
+        print(f'{Fore.YELLOW}Enter your PixelPlanet username or e-mail (leave empty to skip authorization): {Style.RESET_ALL}', end='')
+        return input() or None
+    login = option('login', ask_login)
     extra_ws_headers = []
-    if login != '':
-        passwd = getpass.getpass(f'{Fore.YELLOW}Enter your PixelPlanet password: {Style.RESET_ALL}')
+    if login is not None:
+        passwd = job.get('password') or os.environ.get('PPFUN2_PASSWORD')
+        if passwd is None:
+            passwd = getpass.getpass(f'{Fore.YELLOW}Enter your PixelPlanet password: {Style.RESET_ALL}')
         print(f'{Fore.YELLOW}Authorizing{Style.RESET_ALL}')
-        response = requests.post('https://pixelplanet.fun/api/auth/local', json={'nameoremail':login, 'password':passwd})
-        resp_js = response.json()
-        if 'success' in resp_js and resp_js['success']:
-            print(f'{Fore.YELLOW}Logged in as {Fore.GREEN}{resp_js["me"]["name"]}{Style.RESET_ALL}')
-            # get the token and add it as a WebSocket cookie
-            auth_token = response.cookies.get('pixelplanet.session')
-            extra_ws_headers.append("Cookie: pixelplanet.session=" + auth_token)
-        else:
-            print(f'{Fore.RED}Authorization failed{Style.RESET_ALL}')
+        extra_ws_headers = log_in(login, passwd) or []
 
     # ask for proxy
-    print(f'{Fore.YELLOW}Enter your proxy (host:port), leave empty to not use a proxy: {Style.RESET_ALL}', end='')
-    proxy_host = input()
+    def ask_proxy():
+        print(f'{Fore.YELLOW}Enter your proxy (host:port), leave empty to not use a proxy: {Style.RESET_ALL}', end='')
+        return input() or None
+    proxy_host = option('proxy', ask_proxy)
     proxy_port = None
-    if proxy_host != '':
+    if proxy_host is not None:
         proxy_port = int(proxy_host.split(':')[1])
         proxy_host = proxy_host.split(':')[0]
-    else:
-        proxy_host = None
+    sessions = [(extra_ws_headers, proxy_host, proxy_port)]
+
+    # more accounts
+    def ask_accounts():
+        print(f'{Fore.YELLOW}Enter a path to a JSON file with more accounts to draw with (leave empty to only use one): {Style.RESET_ALL}', end='')
+        return input() or None
+    accounts_path = option('accounts', ask_accounts)
+    if accounts_path is not None:
+        sessions += load_sessions(accounts_path)
+
+    # several images can be listed in the job file as [[templates]], each with an image, x, y, canvas
+    #  and optionally priority, defend, strategy, metric and dither (taken from the top level if left out)
+    templates = job.get('templates')
 
     # request some info from the user
-    print(f'{Fore.YELLOW}Enter a path to the image:{Style.RESET_ALL} ', end='')
-    img_path = input()
+    def ask_image():
+        print(f'{Fore.YELLOW}Enter a path to the image:{Style.RESET_ALL} ', end='')
+        return input()
 
-    print(f'{Fore.YELLOW}Enter the X coordiante of the top-left corner:{Style.RESET_ALL} ', end='')
-    draw_x = int(input())
-    print(f'{Fore.YELLOW}Enter the Y coordiante of the top-left corner:{Style.RESET_ALL} ', end='')
-    draw_y = int(input())
+    def ask_coord(axis):
+        print(f'{Fore.YELLOW}Enter the {axis} coordiante of the top-left corner:{Style.RESET_ALL} ', end='')
+        return int(input())
+    if templates is None:
+        img_path = option('image', ask_image)
+        draw_x = int(option('x', lambda: ask_coord('X')))
+        draw_y = int(option('y', lambda: ask_coord('Y')))
 
     # defend the image?
-    defend = ''
-    while defend not in ['y', 'n', 'yes', 'no']:
-        print(f'{Fore.YELLOW}Defend [y, n]?{Style.RESET_ALL} ', end='')
-        defend = input().lower()
-    defend = True if defend in ['y', 'yes'] else False
+    def ask_defend():
+        defend = ''
+        while defend not in ['y', 'n', 'yes', 'no']:
+            print(f'{Fore.YELLOW}Defend [y, n]?{Style.RESET_ALL} ', end='')
+            defend = input().lower()
+        return defend in ['y', 'yes']
+    defend = option('defend', ask_defend)
 
     # choose a strategy
-    strategies = ['forward', 'backward', 'random']
-    strategy = None
-    while strategy not in strategies:
-        print(f'{Fore.YELLOW}Choose the drawing strategy [forward/backward/random]:{Style.RESET_ALL} ', end='')
-        strategy = input().lower()
-    
+    def ask_strategy():
+        strategy = None
+        while strategy not in STRATEGIES:
+            print(f'{Fore.YELLOW}Choose the drawing strategy [{"/".join(STRATEGIES)}]:{Style.RESET_ALL} ', end='')
+            strategy = input().lower()
+        return strategy
+    strategy = option('strategy', ask_strategy, STRATEGIES)
+
     # choose the canvas
-    canv_id = -1
-    while str(canv_id) not in me['canvases']:
-        print(Fore.YELLOW + '\n'.join(['[' + (Fore.GREEN if ("v" not in me["canvases"][k]) else Fore.RED) + f'{k}{Fore.YELLOW}] ' +
-                                           me['canvases'][k]['title'] for k in me['canvases']]))
-        print(f'Select the canvas [0-{len(me["canvases"]) - 1}]:{Style.RESET_ALL} ', end='')
-        canv_id = input()
-        if 0 <= int(canv_id) <= len(me['canvases']) - 1:
-            if 'v' in me['canvases'][canv_id]:
-                print(Fore.RED + 'This canvas is not supported, only 2D canvases are supported' + Style.RESET_ALL)
-                canv_id = -1
-
-    canv_desc = me['canvases'][canv_id]
-    canv_id = int(canv_id)
-
-    # load the image
-    print(f'{Fore.YELLOW}Loading the image{Style.RESET_ALL}')
-    img = None
-    img_size = (0, 0)
-    try:
-        img = cv2.imread(img_path, cv2.IMREAD_UNCHANGED)
-        img_size = img.shape[:2]
-    except:
-        print(f'{Fore.RED}Failed to load the image. Does it exist? Is it an obscure image format?{Style.RESET_ALL}')
-        exit()
-    # check if it's JPEG
-    img_extension = path.splitext(img_path)[1]
-    if img_extension in ['jpeg', 'jpg']:
-        print(f'{Fore.RED}WARNING: you appear to have loaded a JPEG image. It uses lossy compression, so it\'s not good at all for pixel-art.{Style.RESET_ALL}')
-    
-    # transform the colors
-    print(f'{Fore.YELLOW}Processing the image{Style.RESET_ALL}')
-    color_idxs = np.zeros(img_size, np.uint8)
-    preview = np.zeros((img_size[0], img_size[1], 4), np.uint8)
-    for y in range(img_size[0]):
-        for x in range(img_size[1]):
-            # ignore the pixel if it's transparent
-            transparent = None
-            if img.shape[2] == 3: # the image doesn't have an alpha channel
-                transparent = False
-            else: # the image has an alpha channel
-                if img[y, x][3] > 128:
-                    transparent = False
-                else:
-                    transparent = True
-            if not transparent:
-                # fetch BGR color
-                bgr = img[y, x]
-                bgr = (int(bgr[0]), int(bgr[1]), int(bgr[2]))
-                # find the nearest one in the palette
-                best_diff = 1000000000
-                best_no = 0
-                # ignore the first two colors, they show the land a water colors and are not allowed in the request
-                for i in range(2, len(canv_desc['colors'])):
-                    c_bgr = tuple(canv_desc['colors'][i])
-                    diff = (c_bgr[2] - bgr[0]) ** 2 + (c_bgr[1] - bgr[1]) ** 2 + (c_bgr[0] - bgr[2]) ** 2
-                    if diff < best_diff:
-                        best_diff = diff
-                        best_no = i
-                # store the color idx
-                color_idxs[y, x] = best_no
-                # store the color for preview
-                preview[y, x] = tuple(canv_desc['colors'][best_no] + [255])
-                # PixelPlanet uses RGB, OpenCV uses BGR, need to swap
-                temp = preview[y, x][2]
-                preview[y, x][2] = preview[y, x][0]
-                preview[y, x][0] = temp
+    def ask_canvas():
+        canv_id = -1
+        while str(canv_id) not in me['canvases']:
+            print(Fore.YELLOW + '\n'.join(['[' + (Fore.GREEN if ("v" not in me["canvases"][k]) else Fore.RED) + f'{k}{Fore.YELLOW}] ' +
+                                               me['canvases'][k]['title'] for k in me['canvases']]))
+            print(f'Select the canvas [0-{len(me["canvases"]) - 1}]:{Style.RESET_ALL} ', end='')
+            canv_id = input()
+            if 0 <= int(canv_id) <= len(me['canvases']) - 1:
+                if 'v' in me['canvases'][canv_id]:
+                    print(Fore.RED + 'This canvas is not supported, only 2D canvases are supported' + Style.RESET_ALL)
+                    canv_id = -1
+        return canv_id
+    if templates is None:
+        canv_id = option('canvas', ask_canvas)
+
+    # choose how colors are matched to the palette
+    def ask_metric():
+        metric = None
+        while metric not in COLOR_METRICS:
+            print(f'{Fore.YELLOW}Choose the color matching metric [rgb/lab] (leave empty for rgb):{Style.RESET_ALL} ', end='')
+            metric = input().lower() or 'rgb'
+        return metric
+    metric = option('metric', ask_metric, COLOR_METRICS)
+    def ask_dither():
+        dither = None
+        while dither not in DITHER_MODES:
+            print(f'{Fore.YELLOW}Choose the dithering mode [none/ordered/floyd-steinberg] (leave empty for none):{Style.RESET_ALL} ', end='')
+            dither = input().lower() or 'none'
+        return dither
+    dither = option('dither', ask_dither, DITHER_MODES)
+
+    if templates is None:
+        templates = [{'image': img_path, 'x': draw_x, 'y': draw_y, 'canvas': canv_id}]
+
+    jobs = []
+    # chunk stores by canvas, the images on the same canvas share one
+    stores = {}
+    for template in templates:
+        template = {'priority': 0, 'defend': defend, 'strategy': strategy, 'metric': metric, 'dither': dither, **template}
+        if any(key not in template for key in ['image', 'x', 'y', 'canvas']):
+            print(f'{Fore.RED}Every template needs an image, x, y and canvas{Style.RESET_ALL}')
+            exit()
+        if template['strategy'] not in STRATEGIES or template['metric'] not in COLOR_METRICS or template['dither'] not in DITHER_MODES:
+            print(f'{Fore.RED}Unknown strategy, metric or dithering mode in the template for {template["image"]}{Style.RESET_ALL}')
+            exit()
+        img_path, draw_x, draw_y = template['image'], int(template['x']), int(template['y'])
+        canv_id = str(template['canvas'])
+        if canv_id not in me['canvases'] or 'v' in me['canvases'][canv_id]:
+            print(Fore.RED + f'There\'s no 2D canvas {canv_id}' + Style.RESET_ALL)
+            exit()
+        canv_desc = me['canvases'][canv_id]
+        canv_id = int(canv_id)
+
+        # load the image
+        print(f'{Fore.YELLOW}Loading the image{Style.RESET_ALL}')
+        loaded = None
+        try:
+            # (converting the colors too, unless it's been done before)
+            loaded = load_template(img_path, canv_id, canv_desc['colors'], template['metric'], template['dither'])
+        except OSError:
+            pass
+        if loaded is None:
+            print(f'{Fore.RED}Failed to load the image. Does it exist? Is it an obscure image format?{Style.RESET_ALL}')
+            exit()
+        color_idxs, transparent = loaded
+        # check if it's JPEG
+        img_extension = path.splitext(img_path)[1]
+        if img_extension in ['jpeg', 'jpg']:
+            print(f'{Fore.RED}WARNING: you appear to have loaded a JPEG image. It uses lossy compression, so it\'s not good at all for pixel-art.{Style.RESET_ALL}')
+
+        # show the preview
+        def ask_preview():
+            show_preview = ''
+            while show_preview not in ['y', 'n', 'yes', 'no']:
+                print(f'{Fore.YELLOW}Show the preview [y/n]?{Style.RESET_ALL} ', end='')
+                show_preview = input().lower()
+            return show_preview in ['y', 'yes']
+        # (it's only built if it's shown, it takes as long as reading the whole template)
+        if option('preview', ask_preview):
+            show_image(build_preview(color_idxs, canv_desc['colors']))
+
+        # load the chunks in the region of the image
+        print(f'{Fore.YELLOW}Loading chunk data around the destination{Style.RESET_ALL}')
+        # (only the ones the opaque part of the image is in)
+        if canv_id not in stores:
+            stores[canv_id] = ChunkStore(canv_id, option('chunk_memmap', lambda: JOB_DEFAULTS['chunk_memmap']))
+        store = stores[canv_id]
+        store.load(template_chunks(canv_id, transparent, draw_x, draw_y))
+        # show them
+        def ask_show_area():
+            show_chunks = ''
+            while show_chunks not in ['y', 'n', 'o', 'yes', 'no', 'overlay']:
+                print(f'{Fore.YELLOW}Show the area around the destination [y/n/overlay]?{Style.RESET_ALL} ', end='')
+                show_chunks = input().lower()
+            return show_chunks
+        show_chunks = option('show_area', ask_show_area)
+        if show_chunks in ['y', 'yes', 'o', 'overlay']:
+            print(f'{Fore.YELLOW}Processing...{Style.RESET_ALL}')
+            # the image and a margin around it, sampled so that it fits the window
+            # (the margin is a whole number of steps, so the image lands on the sampled grid)
+            img_h, img_w = color_idxs.shape
+            step = preview_step((img_h + 2 * AREA_MARGIN, img_w + 2 * AREA_MARGIN))
+            margin = -(-AREA_MARGIN // step) * step
+            area = store.region(draw_x - margin, draw_y - margin, img_w + 2 * margin, img_h + 2 * margin, step=step)
+            if show_chunks in ['o', 'overlay']:
+                show_image(render_map(canv_id, area, 1, color_idxs[::step, ::step], (margin // step, margin // step)))
             else:
-                # checkerboard pattern in transparent parts of the image
-                brightness = 0
-                if y % 10 >= 5:
-                    brightness = 128 if x % 10 >= 5 else  64
-                else:
-                    brightness = 64  if x % 10 >= 5 else 128
-                preview[y, x] = (brightness, brightness, brightness, 255)
-                color_idxs[y, x] = 255
-
-    # show the preview
-    show_preview = ''
-    while show_preview not in ['y', 'n', 'yes', 'no']:
-        print(f'{Fore.YELLOW}Show the preview [y/n]?{Style.RESET_ALL} ', end='')
-        show_preview = input().lower()
-    if show_preview in ['y', 'yes']:
-        show_image(preview)
-
-    # load the chunks in the region of the image
-    print(f'{Fore.YELLOW}Loading chunk data around the destination{Style.RESET_ALL}')
-    csz = me['canvases'][str(canv_id)]['size']
-    c_start_y = ((csz // 2) + draw_y) // 256
-    c_start_x = ((csz // 2) + draw_x) // 256
-    c_end_y = ((csz // 2) + draw_y + img.shape[0]) // 256
-    c_end_x = ((csz // 2) + draw_x + img.shape[1]) // 256
-    c_occupied_y = c_end_y - c_start_y + 1
-    c_occupied_x = c_end_x - c_start_x + 1
-    chunk_data = get_chunks(canv_id, c_start_x, c_start_y, c_occupied_x, c_occupied_y)
-    # show them
-    show_chunks = ''
-    while show_chunks not in ['y', 'n', 'yes', 'no']:
-        print(f'{Fore.YELLOW}Show the area around the destination [y/n]?{Style.RESET_ALL} ', end='')
-        show_chunks = input().lower()
-    if show_chunks in ['y', 'yes']:
-        print(f'{Fore.YELLOW}Processing...{Style.RESET_ALL}')
-        show_image(render_map(canv_id, chunk_data))
-
-    start = ''
-    while start not in ['y', 'n', 'yes', 'no']:
-        print(f'{Fore.YELLOW}Draw {Fore.GREEN}{img_path}{Fore.YELLOW} ' +
-              f'at {Fore.GREEN}({draw_x}, {draw_y}){Fore.YELLOW} ' + 
-              f'on canvas {Fore.GREEN}{me["canvases"][str(canv_id)]["title"]} {Fore.YELLOW}[y/n]?{Style.RESET_ALL} ', end='')
-        start = input().lower()
-    # abort if user decided not to draw
-    if start not in ['y', 'yes']:
-        exit()
-
-    # start a WebSockets connection
+                show_image(render_map(canv_id, area))
+        jobs.append(Job(store, color_idxs, draw_x, draw_y, template['defend'], template['strategy'], template['priority']))
+
+    # metrics
+    def ask_metrics():
+        print(f'{Fore.YELLOW}Enter a port to serve metrics on or a file to write them to (leave empty to not export them):{Style.RESET_ALL} ', end='')
+        return input() or None
+    metrics_export = option('metrics', ask_metrics)
+    if type(metrics_export) == str and metrics_export.isdigit():
+        metrics_export = int(metrics_export)
+
+    # pixel log
+    recorder = None
+    pixel_log = option('pixel_log', lambda: JOB_DEFAULTS['pixel_log'])
+    if pixel_log is not None:
+        try:
+            recorder = PixelRecorder(pixel_log, stores)
+        except (PixelLogError, OSError, ValueError) as e:
+            print(f'{Fore.RED}Can\'t log the pixel updates: {e}{Style.RESET_ALL}')
+            exit()
+        print(f'{Fore.YELLOW}Logging the pixel updates to {Fore.GREEN}{pixel_log}{Style.RESET_ALL}')
+
+    if interactive:
+        start = ''
+        while start not in ['y', 'n', 'yes', 'no']:
+            print(f'{Fore.YELLOW}Draw {Fore.GREEN}{img_path}{Fore.YELLOW} ' +
+                  f'at {Fore.GREEN}({draw_x}, {draw_y}){Fore.YELLOW} ' + 
+                  f'on canvas {Fore.GREEN}{me["canvases"][str(canv_id)]["title"]} {Fore.YELLOW}[y/n]?{Style.RESET_ALL} ', end='')
+            start = input().lower()
+        # abort if user decided not to draw
+        if start not in ['y', 'yes']:
+            exit()
+
+    # start a WebSockets connection and draw
     print(f'{Fore.YELLOW}Connecting to the server{Style.RESET_ALL}')
-    ws = websocket.create_connection('wss://pixelplanet.fun:443/ws', header=extra_ws_headers, http_proxy_host=proxy_host, http_proxy_port=proxy_port)
-    select_canvas(ws, canv_id)
-    # register the chunks
-    for c_y in range(c_occupied_y):
-        for c_x in range(c_occupied_x):
-            register_chunk(ws, canv_id, c_x + c_start_x, c_y + c_start_y)
-    # start drawing
-    thr = threading.Thread(target=draw_function, args=(ws, canv_id, draw_x, draw_y, c_start_x, c_start_y, color_idxs, defend, strategy), name='Drawing thread')
-    thr.start()
-    # read server messages
-    while True:
-        data = ws.recv()
-        # text data = chat message
-        if type(data) == str:
-            # data comes as a JS array
-            msg = json.loads('{"msg":' + data + '}')
-            msg = msg['msg']
-            print(f'{Fore.GREEN}{msg[0]}{Fore.YELLOW} (country: {Fore.GREEN}{msg[2]}{Fore.YELLOW}) ' + 
-                    f'says: {Fore.GREEN}{msg[1]}{Fore.YELLOW} in chat {Fore.GREEN}{"int" if msg[2] == 0 else "en"}{Style.RESET_ALL}')
-        # binary data = event
-        else:
-            opcode = data[0]
-            # online counter
-            if opcode == 0xA7:
-                oc = (data[1] << 8) | data[2]
-                print(f'{Fore.YELLOW}Online counter: {Fore.GREEN}{oc}{Style.RESET_ALL}')
-
-            # total cooldown packet
-            elif opcode == 0xC2:
-                cd = (data[4] << 24) | (data[3] << 16) | (data[2] << 8) | data[1]
-                print(f'{Fore.YELLOW}Total cooldown: {Fore.GREEN}{cd} ms{Style.RESET_ALL}')
-
-            # pixel return packet
-            elif opcode == 0xC3:
-                rc = data[1]
-                wait = (data[2] << 24) | (data[3] << 16) | (data[4] << 8) | data[5]
-                cd_s = (data[6] << 8) | data[7]
-                print(f'{Fore.YELLOW}Pixel return{Fore.YELLOW} (code: {Fore.RED if rc != 0 else Fore.GREEN}{rc}{Fore.YELLOW}): ' + 
-                        f'wait: {Fore.GREEN}{wait}{Fore.YELLOW} ms {Fore.GREEN}[+{cd_s} s]{Style.RESET_ALL}')
-                # CAPTCHA error
-                if rc == 10:
-                    draw = False
-                    play_notification()
-                    print(Fore.RED + 'Place a pixel somewhere manually and enter CAPTCHA' + Style.RESET_ALL)
-                # any error
-                if rc != 0:
-                    time.sleep(2)
-                    succ = False
-                    draw = True
-                # placement was successful
-                else:
-                    if wait >= 30000:
-                        print(f'{Fore.YELLOW}Cooling down{Style.RESET_ALL}')
-                        # wait that many seconds plus 1 (to be sure)
-                        time.sleep(cd_s + 1)
-                    succ = True
-                    draw = True
-
-            # pixel update
-            elif opcode == 0xC1:
-                # get raw data
-                i = data[1]
-                j = data[2]
-                offs = (data[3] << 16) | (data[4] << 8) | data[5]
-                clr = data[6]
-                # convert it to X and Y coords
-                csz = me['canvases'][str(canv_id)]['size']
-                x = ((i * 256) - (csz // 2)) + (offs & 0xFF)
-                y = ((j * 256) - (csz // 2)) + ((offs >> 8) & 0xFF)
-                print(f'{Fore.YELLOW}Pixel update at {Fore.GREEN}({str(x)}, {str(y)}){Style.RESET_ALL}')
-                # write that change
-                local_x = (i - c_start_x) * 256 + (offs & 0xFF)
-                local_y = (j - c_start_y) * 256 + ((offs >> 8) & 0xFF)
-                chunk_data[local_y, local_x] = clr
-            else:
-                print(f'{Fore.RED}Unreconized data opcode from the server. Raw data: {data}{Style.RESET_ALL}')
+    try:
+        asyncio.run(run_bot(sessions, jobs, metrics_export, recorder))
+    except PlacementError as e:
+        print(f'{Fore.RED}The server doesn\'t let us draw: {e}{Style.RESET_ALL}')
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+
+# A local PixelPlanet stand-in server and a throughput harness for ppfun2
+# Distributed under WTFPL
+#
+# python ppsim.py serve            runs the server until Ctrl+C
+# python ppsim.py bench            runs the bot against it and reports its throughput
+
+import asyncio, threading, argparse, os
+import base64, hashlib, struct, json
+import time, random, io, contextlib
+import numpy as np
+
+# the palette the simulated canvas uses (first two are land and water, like on the real server)
+SIM_COLORS = [[202, 227, 255], [255, 255, 255]] + \
+             [[r, g, b] for r in (0, 85, 170, 255) for g in (0, 128, 255) for b in (0, 255)]
+
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+# a WebSocket connection to the simulator
+class SimConnection:
+    def __init__(self, writer):
+        self.writer = writer
+        self.canvas = 0
+        self.chunks = set()
+        # canvas -> time.monotonic() when the cooldown counter drains to zero
+        self.empty_at = {}
+
+    def send(self, data, opcode=0x2):
+        n = len(data)
+        if n < 126:
+            header = struct.pack('>BB', 0x80 | opcode, n)
+        elif n < 65536:
+            header = struct.pack('>BBH', 0x80 | opcode, 126, n)
+        else:
+            header = struct.pack('>BBQ', 0x80 | opcode, 127, n)
+        self.writer.write(header + data)
+
+# serves /api/me, /api/auth/local, /chunks/{d}/{x}/{y}.bmp and /ws
+#  speaking the same binary protocol ppfun2 does
+class SimServer:
+    def __init__(self, canvas_size=4096, cooldown_ms=1000, stack_ms=6000, latency_ms=0,
+                 captcha_rate=0, grief_rate=0, seed=0, canvases=1):
+        self.size = canvas_size
+        self.cost = cooldown_ms / 1000
+        self.stack = stack_ms / 1000
+        self.latency = latency_ms / 1000
+        self.captcha_rate = captcha_rate
+        self.grief_rate = grief_rate
+        self.random = random.Random(seed)
+        self.canvases = [np.zeros((canvas_size, canvas_size), np.uint8) for _ in range(canvases)]
+        # (canvas, i, j) of chunks that were painted at least once, and how many times they changed
+        self.versions = {}
+        self.connections = set()
+        self.port = None
+        self.loop = None
+        self.ready = threading.Event()
+        # placement statistics
+        self.placed_at = []
+        self.return_codes = {}
+        self.griefed = 0
+        # (canvas, x, y, w, h) areas the griefer goes after instead of random watched chunks,
+        #  most of its pixels land around a few hot spots in each of them
+        self.targets = []
+        self.hotspots = 3
+        # (seconds since the griefer started, canvas, x, y, color) of every griefed pixel,
+        #  replayed instead of griefing randomly if grief_trace is set
+        self.grief_log = []
+        self.grief_trace = None
+        # if set, connections without a session cookie can't place pixels (like on some real canvases)
+        self.registered_only = False
+
+    def me(self):
+        return {'name': None, 'canvases': {str(d): {
+            'title': f'Simulated canvas {d}', 'size': self.size, 'colors': SIM_COLORS,
+            'bcd': int(self.cost * 1000), 'pcd': int(self.cost * 1000), 'cds': int(self.stack * 1000)}
+            for d in range(len(self.canvases))}}
+
+    # starts serving in a background thread, returns the port
+    def start(self, host='127.0.0.1', port=0):
+        threading.Thread(target=asyncio.run, args=(self.serve(host, port),), name='Simulator', daemon=True).start()
+        self.ready.wait()
+        return self.port
+
+    async def serve(self, host='127.0.0.1', port=0):
+        server = await asyncio.start_server(self._handle, host, port)
+        self.port = server.sockets[0].getsockname()[1]
+        # (for changing pixels from other threads with call_soon_threadsafe())
+        self.loop = asyncio.get_running_loop()
+        self.ready.set()
+        tasks = [asyncio.create_task(self._online_counter())]
+        if self.grief_trace is not None:
+            tasks.append(asyncio.create_task(self._replay_griefs(self.grief_trace)))
+        elif self.grief_rate > 0:
+            tasks.append(asyncio.create_task(self._griefer()))
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                lines = head.decode('latin-1').split('\r\n')
+                method, target, _ = lines[0].split(' ', 2)
+                headers = {k.strip().lower(): v.strip() for k, v in (l.split(':', 1) for l in lines[1:] if ':' in l)}
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                if headers.get('upgrade', '').lower() == 'websocket':
+                    await self._websocket(reader, writer, headers)
+                    return
+                self._http(writer, method, target, headers, body)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def _http(self, writer, method, target, headers, body):
+        status, extra, content = '404 Not Found', {}, b''
+        parts = target.split('?')[0].strip('/').split('/')
+        if parts == ['api', 'me']:
+            status, content = '200 OK', json.dumps(self.me()).encode()
+        elif parts == ['api', 'auth', 'local'] and method == 'POST':
+            name = json.loads(body or b'{}').get('nameoremail', 'user')
+            status, content = '200 OK', json.dumps({'success': True, 'me': {'name': name}}).encode()
+            extra['Set-Cookie'] = f'pixelplanet.session={hashlib.sha1(name.encode()).hexdigest()}; Path=/'
+        elif len(parts) == 4 and parts[0] == 'chunks' and parts[3].endswith('.bmp'):
+            d, i, j = int(parts[1]), int(parts[2]), int(parts[3][:-4])
+            version = self.versions.get((d, i, j))
+            etag = f'"{d}-{i}-{j}-{version}"'
+            extra['ETag'] = etag
+            if headers.get('if-none-match') == etag:
+                status = '304 Not Modified'
+            else:
+                status = '200 OK'
+                # never painted chunks come back empty, just like on the real server
+                if version is not None:
+                    content = self.canvases[d][j * 256:(j + 1) * 256, i * 256:(i + 1) * 256].tobytes()
+        head = f'HTTP/1.1 {status}\r\nContent-Length: {len(content)}\r\n'
+        head += ''.join(f'{k}: {v}\r\n' for k, v in extra.items())
+        writer.write(head.encode() + b'\r\n' + content)
+
+    async def _websocket(self, reader, writer, headers):
+        accept = base64.b64encode(hashlib.sha1((headers['sec-websocket-key'] + WS_GUID).encode()).digest()).decode()
+        writer.write(('HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n' +
+                      f'Sec-WebSocket-Accept: {accept}\r\n\r\n').encode())
+        conn = SimConnection(writer)
+        conn.registered = 'pixelplanet.session=' in headers.get('cookie', '')
+        self.connections.add(conn)
+        try:
+            # total cooldown packet (big-endian, like the real server's DataView.setUint32())
+            conn.send(struct.pack('>BI', 0xC2, 0))
+            while True:
+                b1, b2 = await reader.readexactly(2)
+                opcode, n = b1 & 0x0F, b2 & 0x7F
+                if n == 126:
+                    n = struct.unpack('>H', await reader.readexactly(2))[0]
+                elif n == 127:
+                    n = struct.unpack('>Q', await reader.readexactly(8))[0]
+                mask = await reader.readexactly(4) if b2 & 0x80 else b'\0\0\0\0'
+                data = bytes(b ^ mask[k & 3] for k, b in enumerate(await reader.readexactly(n)))
+                if opcode == 0x8:
+                    conn.send(b'', 0x8)
+                    return
+                elif opcode == 0x9:
+                    conn.send(data, 0xA)
+                elif opcode == 0x2 and len(data) > 0:
+                    await self._packet(conn, data)
+                await writer.drain()
+        finally:
+            self.connections.discard(conn)
+
+    async def _packet(self, conn, data):
+        opcode = data[0]
+        # select canvas
+        if opcode == 0xA0:
+            conn.canvas = data[1]
+            conn.chunks.clear()
+        # register chunk
+        elif opcode == 0xA1:
+            conn.chunks.add((data[1], data[2]))
+        # place pixel
+        elif opcode == 0xC1:
+            if self.latency > 0:
+                await asyncio.sleep(self.latency)
+            i, j, offs, clr = data[1], data[2], (data[3] << 16) | (data[4] << 8) | data[5], data[6]
+            now = time.monotonic()
+            wait = max(0, conn.empty_at.get(conn.canvas, 0) - now)
+            if self.captcha_rate > 0 and self.random.random() < self.captcha_rate:
+                rc = 10
+            elif not 2 <= clr < len(SIM_COLORS):
+                rc = 5
+            elif conn.canvas >= len(self.canvases):
+                rc = 1
+            elif self.registered_only and not conn.registered:
+                rc = 6
+            elif i * 256 >= self.size or j * 256 >= self.size:
+                rc = 2
+            elif wait + self.cost > self.stack:
+                rc = 9
+            else:
+                rc = 0
+                wait += self.cost
+                conn.empty_at[conn.canvas] = now + wait
+                self.placed_at.append(now)
+                self._set_pixel(conn.canvas, i, j, offs, clr)
+            self.return_codes[rc] = self.return_codes.get(rc, 0) + 1
+            # pixel return packet
+            conn.send(struct.pack('>BBIH', 0xC3, rc, int(wait * 1000), round(self.cost)))
+
+    # changes a pixel and tells everyone who's watching its chunk
+    def _set_pixel(self, d, i, j, offs, clr):
+        self.canvases[d][j * 256 + ((offs >> 8) & 0xFF), i * 256 + (offs & 0xFF)] = clr
+        self.versions[(d, i, j)] = self.versions.get((d, i, j), 0) + 1
+        packet = struct.pack('>BBBBHB', 0xC1, i, j, offs >> 16, offs & 0xFFFF, clr)
+        for conn in list(self.connections):
+            if conn.canvas == d and (i, j) in conn.chunks:
+                conn.send(packet)
+
+    async def _online_counter(self):
+        while True:
+            for conn in list(self.connections):
+                conn.send(struct.pack('>BH', 0xA7, len(self.connections)))
+            await asyncio.sleep(5)
+
+    # changes a pixel given in the bot's coordinates
+    def _grief(self, d, x, y, clr):
+        x, y = x + self.size // 2, y + self.size // 2
+        self._set_pixel(d, x // 256, y // 256, (y % 256) * 256 + x % 256, clr)
+        self.griefed += 1
+
+    # paints random pixels in the targets (or in the watched chunks if there are none)
+    async def _griefer(self):
+        spots = {}
+        start = time.monotonic()
+        while True:
+            await asyncio.sleep(self.random.expovariate(self.grief_rate))
+            clr = self.random.randrange(2, len(SIM_COLORS))
+            if self.targets:
+                n = self.random.randrange(len(self.targets))
+                d, x, y, w, h = self.targets[n]
+                if n not in spots:
+                    spots[n] = [(self.random.randrange(x, x + w), self.random.randrange(y, y + h))
+                                for _ in range(self.hotspots)]
+                if self.random.random() < 0.8:
+                    sx, sy = self.random.choice(spots[n])
+                    px = min(max(round(self.random.gauss(sx, 3)), x), x + w - 1)
+                    py = min(max(round(self.random.gauss(sy, 3)), y), y + h - 1)
+                else:
+                    px, py = self.random.randrange(x, x + w), self.random.randrange(y, y + h)
+            else:
+                watched = sorted({(conn.canvas, i, j) for conn in self.connections for i, j in conn.chunks})
+                if not watched:
+                    continue
+                d, i, j = self.random.choice(watched)
+                offs = self.random.randrange(65536)
+                px = i * 256 + (offs & 0xFF) - self.size // 2
+                py = j * 256 + (offs >> 8) - self.size // 2
+            self.grief_log.append((time.monotonic() - start, d, px, py, clr))
+            self._grief(d, px, py, clr)
+
+    # paints the pixels from a grief log at the same times they were painted before
+    async def _replay_griefs(self, log):
+        start = time.monotonic()
+        for t, d, x, y, clr in log:
+            await asyncio.sleep(max(start + t - time.monotonic(), 0))
+            self.grief_log.append((t, d, x, y, clr))
+            self._grief(d, x, y, clr)
+
+    # part of the canvas in the bot's coordinates
+    def area(self, x, y, w, h, d=0):
+        half = self.size // 2
+        return self.canvases[d][y + half:y + half + h, x + half:x + half + w]
+
+def add_server_args(parser):
+    parser.add_argument('--canvas-size', type=int, default=4096)
+    parser.add_argument('--cooldown-ms', type=int, default=1000, help='cooldown added by every pixel')
+    parser.add_argument('--stack-ms', type=int, default=6000, help='cooldown stack limit')
+    parser.add_argument('--latency-ms', type=int, default=0, help='delay before answering a placement')
+    parser.add_argument('--captcha-rate', type=float, default=0, help='chance of a placement asking for a CAPTCHA')
+    parser.add_argument('--grief-rate', type=float, default=0, help='random pixels painted per second')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--canvases', type=int, default=1, help='number of canvases')
+
+def make_server(args):
+    return SimServer(args.canvas_size, args.cooldown_ms, args.stack_ms, args.latency_ms,
+                     args.captcha_rate, args.grief_rate, args.seed, args.canvases)
+
+# a template like pixel art: flat circles with black outlines on a flat background
+# (most of the pixels are in flat areas, so it matters which ones are repaired first)
+def shapes_template(size, rng):
+    img = np.full((size, size), rng.integers(3, len(SIM_COLORS)), np.uint8)
+    ys, xs = np.mgrid[:size, :size]
+    for _ in range(max(1, size // 16)):
+        cx, cy = rng.integers(0, size, 2)
+        r = rng.integers(size // 16 + 2, size // 4 + 3)
+        inside = (xs - cx) ** 2 + (ys - cy) ** 2 <= r * r
+        img[inside] = rng.integers(3, len(SIM_COLORS))
+        padded = np.pad(inside, 1)
+        edge = inside & ~(padded[:-2, 1:-1] & padded[2:, 1:-1] & padded[1:-1, :-2] & padded[1:-1, 2:])
+        img[edge] = 2
+    return img
+
+# runs the bot against the simulator and measures how it does
+def bench(args):
+    import requests
+    import ppfun2
+
+    sim = make_server(args)
+    port = sim.start()
+    ppfun2.PPFUN_URL = f'http://127.0.0.1:{port}'
+    ppfun2.PPFUN_WS_URL = f'ws://127.0.0.1:{port}/ws'
+    ppfun2.chunk_loader = ppfun2.ChunkLoader(cache_dir=None)
+    ppfun2.play_notification = lambda: None
+    ppfun2.DEFEND_ORDER = args.defend_order
+
+    # time how long placements take from the bot's side
+    latencies = []
+    place = ppfun2.Client.place
+    async def timed_place(self, *a):
+        start = time.monotonic()
+        result = await place(self, *a)
+        latencies.append(time.monotonic() - start)
+        return result
+    ppfun2.Client.place = timed_place
+
+    # templates side by side, spread over the canvases, the later ones more important
+    rng = np.random.default_rng(args.seed)
+    def make_template():
+        if args.template == 'noise':
+            return rng.integers(2, len(SIM_COLORS), (args.size, args.size)).astype(np.uint8)
+        return shapes_template(args.size, rng)
+    templates = [(n % args.canvases, args.x + n // args.canvases * args.size, args.y, make_template())
+                 for n in range(args.templates)]
+
+    sim.targets = [(d, draw_x, draw_y, args.size, args.size) for d, draw_x, draw_y, _ in templates]
+    # grief the same pixels at the same times as a previous run, so runs can be compared
+    if args.grief_trace and os.path.exists(args.grief_trace):
+        with open(args.grief_trace) as f:
+            sim.grief_trace = [tuple(event) for event in json.load(f)]
+
+    # how correct the templates are over time, plain and weighted by how much the pixels matter
+    samples = []
+    def correctness():
+        right = [sim.area(draw_x, draw_y, args.size, args.size, d) == img for d, draw_x, draw_y, img in templates]
+        weights = [ppfun2.pixel_importance(img, SIM_COLORS) for _, _, _, img in templates]
+        return (np.mean([r.mean() for r in right]) * 100,
+                np.mean([(r * w).sum() / w.sum() for r, w in zip(right, weights)]) * 100)
+    async def sample():
+        while True:
+            await asyncio.sleep(args.sample_every)
+            samples.append((time.monotonic() - start,) + correctness())
+    async def run():
+        sampler = asyncio.create_task(sample())
+        try:
+            await asyncio.wait_for(ppfun2.run_bot(sessions, jobs, args.metrics, recorder), args.duration)
+        finally:
+            sampler.cancel()
+
+    start = time.monotonic()
+    log = io.StringIO()
+    with contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(log):
+        ppfun2.me = requests.get(f'{ppfun2.PPFUN_URL}/api/me').json()
+        stores = {d: ppfun2.ChunkStore(d) for d in range(args.canvases)}
+        jobs = []
+        for n, (d, draw_x, draw_y, img) in enumerate(templates):
+            stores[d].load(ppfun2.template_chunks(d, img == 255, draw_x, draw_y))
+            jobs.append(ppfun2.Job(stores[d], img, draw_x, draw_y, args.defend, args.strategy, n))
+        sessions = [([], None, None)] * args.sessions
+        recorder = ppfun2.PixelRecorder(args.pixel_log, stores) if args.pixel_log else None
+        try:
+            asyncio.run(run())
+        except asyncio.TimeoutError:
+            pass
+    end = time.monotonic()
+
+    placed = len(sim.placed_at)
+    correct, weighted = correctness()
+    if args.grief_trace and sim.grief_trace is None:
+        with open(args.grief_trace, 'w') as f:
+            json.dump(sim.grief_log, f)
+    print(f'pixels placed:        {placed} in {end - start:.2f} s')
+    if placed > 0:
+        print(f'time to first pixel:  {(sim.placed_at[0] - start) * 1000:.1f} ms')
+        print(f'throughput:           {placed / (end - start):.2f} pixels/s overall, ' +
+              f'{placed / max(sim.placed_at[-1] - sim.placed_at[0], 1e-9):.2f} pixels/s while drawing')
+    if latencies:
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1000
+        print(f'placement latency:    p50 {p50:.1f} ms, p90 {p90:.1f} ms, p99 {p99:.1f} ms')
+    print(f'return codes:         {dict(sorted(sim.return_codes.items()))}')
+    if sim.griefed:
+        print(f'griefed pixels:       {sim.griefed}')
+    print(f'correct pixels:       {correct:.2f}% ({weighted:.2f}% weighted by importance)')
+    if samples:
+        print('over time:            ' + ', '.join(f'{t:.0f} s {c:.1f}% ({w:.1f}%)' for t, c, w in samples))
+        # after the image is drawn for the first time, i.e. what defending keeps it at
+        settled = [(c, w) for _, c, w in samples[len(samples) // 2:]]
+        print(f'second half average:  {np.mean([c for c, _ in settled]):.2f}% ' +
+              f'({np.mean([w for _, w in settled]):.2f}% weighted)')
+
+def main():
+    parser = argparse.ArgumentParser(description='Local PixelPlanet stand-in for testing and benchmarking ppfun2')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve = commands.add_parser('serve', help='run the server until interrupted')
+    add_server_args(serve)
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8080)
+
+    bench_cmd = commands.add_parser('bench', help='run the bot against the server and report its throughput')
+    add_server_args(bench_cmd)
+    bench_cmd.add_argument('--size', type=int, default=64, help='side of the template')
+    bench_cmd.add_argument('--template', default='shapes', choices=['shapes', 'noise'],
+                           help='outlined flat shapes, or random colors (where every pixel matters the same)')
+    bench_cmd.add_argument('--templates', type=int, default=1, help='number of templates, spread over the canvases')
+    bench_cmd.add_argument('--x', type=int, default=0, help='X coordinate of the template')
+    bench_cmd.add_argument('--y', type=int, default=0, help='Y coordinate of the template')
+    bench_cmd.add_argument('--sessions', type=int, default=1)
+    bench_cmd.add_argument('--strategy', default='forward')
+    bench_cmd.add_argument('--defend', action='store_true')
+    bench_cmd.add_argument('--defend-order', default='priority', choices=['priority', 'raster'],
+                           help='order defend mode repairs pixels in')
+    bench_cmd.add_argument('--grief-trace', help='file to replay griefing from, or to record it to if it does not exist')
+    bench_cmd.add_argument('--pixel-log', help='directory to log the pixel updates the bot receives to')
+    bench_cmd.add_argument('--sample-every', type=float, default=5, help='seconds between correctness samples')
+    bench_cmd.add_argument('--duration', type=float, default=30, help='stop the bot after that many seconds')
+    bench_cmd.add_argument('--verbose', action='store_true', help='show the bot output')
+    bench_cmd.add_argument('--metrics', type=lambda v: int(v) if v.isdigit() else v,
+                           help='port to serve the bot metrics on or file to write them to')
+
+    args = parser.parse_args()
+    if args.command == 'serve':
+        print(f'Serving on http://{args.host}:{args.port}, run ppfun2.py --server http://{args.host}:{args.port} to use it')
+        try:
+            asyncio.run(make_server(args).serve(args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+    else:
+        bench(args)
+
+if __name__ == "__main__":
+    main()
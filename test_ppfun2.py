@@ -0,0 +1,635 @@
+#!/usr/bin/env python3
+
+# Tests for ppfun2
+# Distributed under WTFPL
+#
+# python -m unittest test_ppfun2     (or python -m pytest test_ppfun2.py)
+
+import asyncio, contextlib, io, math, os, tempfile, time, unittest
+import numpy as np
+import requests
+import ppfun2, ppsim
+
+# runs the bot against a simulator for some time
+def run_bot_against(sim, jobs, duration, sessions=1):
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            asyncio.run(asyncio.wait_for(ppfun2.run_bot([([], None, None)] * sessions, jobs), duration))
+        except asyncio.TimeoutError:
+            pass
+
+# runs the bot against a simulator until done() says it has done its job (checked every 50 ms),
+#  fails if it stops before that or if that takes longer than timeout seconds
+def run_bot_until(sim, jobs, done, timeout=120, sessions=1):
+    async def run():
+        bot = asyncio.create_task(ppfun2.run_bot([([], None, None)] * sessions, jobs))
+        deadline = time.monotonic() + timeout
+        try:
+            while not done():
+                if bot.done():
+                    bot.result()
+                    raise AssertionError('the bot stopped too early')
+                if time.monotonic() > deadline:
+                    raise AssertionError(f'the bot didn\'t get it done in {timeout} s')
+                await asyncio.sleep(0.05)
+        finally:
+            bot.cancel()
+            await asyncio.gather(bot, return_exceptions=True)
+    with contextlib.redirect_stdout(io.StringIO()):
+        asyncio.run(run())
+
+# starts a simulator and points ppfun2 at it
+def start_sim(**kwargs):
+    sim = ppsim.SimServer(**kwargs)
+    port = sim.start()
+    ppfun2.PPFUN_URL = f'http://127.0.0.1:{port}'
+    ppfun2.PPFUN_WS_URL = f'ws://127.0.0.1:{port}/ws'
+    ppfun2.chunk_loader = ppfun2.ChunkLoader(cache_dir=None)
+    ppfun2.play_notification = lambda: None
+    ppfun2.me = requests.get(f'{ppfun2.PPFUN_URL}/api/me').json()
+    ppfun2.canvas_geometries.clear()
+    return sim
+
+# a stand-in for the WebSocket that keeps the last packet
+class Sink:
+    def send_binary(self, data):
+        self.data = bytes(data)
+
+class PacketTest(unittest.TestCase):
+    # canvas sizes to test with, by canvas ID
+    SIZES = {0: 65536, 1: 4096, 2: 1024, 3: 256}
+
+    def setUp(self):
+        ppfun2.me = {'canvases': {str(d): {'size': size, 'colors': ppsim.SIM_COLORS} for d, size in self.SIZES.items()}}
+        ppfun2.canvas_geometries.clear()
+
+    # random pixels and the corners of the canvas
+    def coords(self, size, count=2000):
+        rng = np.random.default_rng(size)
+        half = size // 2
+        xs = np.r_[-half, half - 1, -half, half - 1, 0, -1, rng.integers(-half, half, count)]
+        ys = np.r_[-half, -half, half - 1, half - 1, 0, -1, rng.integers(-half, half, count)]
+        cs = rng.integers(0, 128, len(xs))
+        return xs, ys, cs
+
+    def test_place_pixel_round_trip(self):
+        sink = Sink()
+        for d, size in self.SIZES.items():
+            geometry = ppfun2.canvas_geometry(d)
+            for x, y, c in zip(*(a.tolist() for a in self.coords(size))):
+                ppfun2.place_pixel(sink, d, x, y, c)
+                self.assertEqual(len(sink.data), ppfun2.PIXEL.size)
+                packet = ppfun2.decode_packet(sink.data)
+                self.assertEqual(type(packet), ppfun2.PixelUpdate)
+                self.assertEqual(geometry.from_packet(packet.i, packet.j, packet.offs) + (packet.clr,), (x, y, c))
+
+    def test_encode_pixels_round_trip(self):
+        sink = Sink()
+        for d, size in self.SIZES.items():
+            xs, ys, cs = self.coords(size)
+            packets = ppfun2.encode_pixels(d, xs, ys, cs)
+            # the same packets one at a time and in a batch
+            for packet, x, y, c in zip(packets, xs.tolist(), ys.tolist(), cs.tolist()):
+                ppfun2.place_pixel(sink, d, x, y, c)
+                self.assertEqual(packet, sink.data)
+            i, j, offs, clr = ppfun2.decode_pixel_updates(packets)
+            rx, ry = ppfun2.canvas_geometry(d).from_packet(i.astype(np.int64), j.astype(np.int64), offs)
+            self.assertTrue((rx == xs).all() and (ry == ys).all() and (clr == cs).all())
+
+    # offsets are 24 bits in the packet, both decoders have to keep the high byte
+    def test_24_bit_offsets(self):
+        rng = np.random.default_rng(0)
+        offs = np.r_[0, 0xFFFF, 0x10000, 0xFFFFFF, rng.integers(0, 1 << 24, 1000)]
+        packets = [ppfun2.PIXEL.pack(0xC1, 7, 9, o >> 16, o & 0xFFFF, 3) for o in offs.tolist()]
+        for packet, o in zip(packets, offs.tolist()):
+            self.assertEqual(ppfun2.decode_packet(packet), ppfun2.PixelUpdate(7, 9, o, 3))
+        i, j, batch_offs, clr = ppfun2.decode_pixel_updates(packets)
+        self.assertTrue((batch_offs == offs).all() and (i == 7).all() and (j == 9).all() and (clr == 3).all())
+        # only the low 16 bits say where the pixel is
+        geometry = ppfun2.canvas_geometry(0)
+        self.assertEqual(geometry.from_packet(7, 9, 0x12345), geometry.from_packet(7, 9, 0x2345))
+
+    def test_short_packets(self):
+        for data in (b'', bytes([0xC1, 1, 2]), bytes([0xC3, 0])):
+            self.assertEqual(type(ppfun2.decode_packet(data)), ppfun2.UnknownPacket)
+
+    # the server writes the total cooldown with DataView.setUint32(), which is big-endian
+    def test_total_cooldown(self):
+        packet = ppfun2.decode_packet(bytes([0xC2]) + (90000).to_bytes(4, 'big'))
+        self.assertEqual(packet, ppfun2.TotalCooldown(90000))
+
+    # a reported counter above the stack limit is waited out in full
+    def test_cooldown_above_stack(self):
+        scheduler = ppfun2.CooldownScheduler({'bcd': 1000, 'pcd': 1000, 'cds': 6000})
+        scheduler.update(90000)
+        self.assertGreater(scheduler.delay(), 80)
+
+# converts one RGB color into CIELAB, the straightforward way
+def reference_lab(rgb):
+    r, g, b = (((c / 255 + 0.055) / 1.055) ** 2.4 if c / 255 > 0.04045 else c / 255 / 12.92 for c in rgb)
+    xyz = (0.4124 * r + 0.3576 * g + 0.1805 * b, 0.2126 * r + 0.7152 * g + 0.0722 * b, 0.0193 * r + 0.1192 * g + 0.9505 * b)
+    fx, fy, fz = (v ** (1 / 3) if v > 216 / 24389 else (24389 / 27 * v + 16) / 116
+                  for v in (xyz[0] / 0.95047, xyz[1], xyz[2] / 1.08883))
+    return (116 * fy - 16, 500 * (fx - fy), 200 * (fy - fz))
+
+# quantize_image() one pixel at a time, like ppfun2 used to do it
+def reference_quantize(img, colors, metric, dither):
+    if img.ndim == 2:
+        img = np.repeat(img[:, :, None], 3, axis=2)
+    h, w = img.shape[:2]
+    space = reference_lab if metric == 'lab' else lambda c: tuple(c)
+    palette = colors[2:]
+    pal_points = [space(c) for c in palette]
+    work = img[:, :, 2::-1].astype(np.float64)
+    out = np.full((h, w), 255, np.uint8)
+    for y in range(h):
+        for x in range(w):
+            if img.shape[2] == 4 and img[y, x, 3] <= 128:
+                continue
+            rgb = [float(c) for c in work[y, x]]
+            if dither == 'ordered':
+                rgb = [min(255, max(0, c + ppfun2.BAYER_8X8[y % 8, x % 8] * 32)) for c in rgb]
+                rgb = [float(round(c)) for c in rgb]
+            elif dither == 'floyd-steinberg':
+                rgb = [min(255, max(0, c)) for c in rgb]
+            point = space(rgb)
+            best_diff, best_no = None, None
+            for n, p in enumerate(pal_points):
+                diff = sum((a - b) ** 2 for a, b in zip(point, p))
+                if best_diff is None or diff < best_diff:
+                    best_diff, best_no = diff, n
+            out[y, x] = best_no + 2
+            if dither == 'floyd-steinberg':
+                err = [c - p for c, p in zip(rgb, palette[best_no])]
+                for dy, dx, k in ((0, 1, 7 / 16), (1, -1, 3 / 16), (1, 0, 5 / 16), (1, 1, 1 / 16)):
+                    if y + dy < h and 0 <= x + dx < w:
+                        work[y + dy, x + dx] += [e * k for e in err]
+    return out
+
+class QuantizeTest(unittest.TestCase):
+    # the land and water colors are exactly in the image, but they can't be placed
+    COLORS = [[202, 227, 255], [255, 255, 255]] + ppsim.SIM_COLORS[2:]
+
+    def image(self, channels):
+        rng = np.random.default_rng(channels)
+        img = rng.integers(0, 256, (24, 20, channels), np.uint8)
+        # some of the land and water colors (in BGR), and alpha around the threshold
+        img[0, :2, :3] = [self.COLORS[0][::-1], self.COLORS[1][::-1]]
+        if channels == 4:
+            img[:, :, 3] = rng.choice([0, 127, 128, 129, 200, 255], img.shape[:2])
+        return img
+
+    def test_rgb_to_lab(self):
+        self.assertTrue(np.allclose(ppfun2.rgb_to_lab([[255, 255, 255], [0, 0, 0]]), [[100, 0, 0], [0, 0, 0]], atol=0.05))
+        self.assertTrue(np.allclose(ppfun2.rgb_to_lab([255, 0, 0]), [53.24, 80.09, 67.20], atol=0.05))
+        rgb = np.random.default_rng(0).integers(0, 256, (200, 3))
+        self.assertTrue(np.allclose(ppfun2.rgb_to_lab(rgb), [reference_lab(c) for c in rgb.tolist()]))
+
+    # every metric and dithering mode gives what the per-pixel loop gives
+    def test_against_reference(self):
+        for channels in (3, 4):
+            img = self.image(channels)
+            for metric in ppfun2.COLOR_METRICS:
+                for dither in ppfun2.DITHER_MODES:
+                    with self.subTest(channels=channels, metric=metric, dither=dither):
+                        self.assertEqual(ppfun2.quantize_image(img, self.COLORS, metric, dither).tolist(),
+                                         reference_quantize(img, self.COLORS, metric, dither).tolist())
+
+    def test_transparency(self):
+        img = self.image(4)
+        for metric in ppfun2.COLOR_METRICS:
+            for dither in ppfun2.DITHER_MODES:
+                idxs = ppfun2.quantize_image(img, self.COLORS, metric, dither)
+                self.assertTrue(((idxs == 255) == (img[:, :, 3] <= 128)).all())
+                self.assertTrue((idxs >= 2).all())
+
+    # grayscale images are quantized like the same gray in color, without transparency
+    def test_grayscale(self):
+        gray = self.image(3)[:, :, 0]
+        for metric in ppfun2.COLOR_METRICS:
+            for dither in ppfun2.DITHER_MODES:
+                idxs = ppfun2.quantize_image(gray, self.COLORS, metric, dither)
+                self.assertEqual(idxs.tolist(), ppfun2.quantize_image(np.repeat(gray[:, :, None], 3, axis=2), self.COLORS, metric, dither).tolist())
+                self.assertTrue(((idxs >= 2) & (idxs < len(self.COLORS))).all())
+
+class ChunkLoaderTest(unittest.TestCase):
+    def setUp(self):
+        self.sim = start_sim(canvas_size=1024)
+        self.cache = tempfile.TemporaryDirectory()
+        self.loader = ppfun2.ChunkLoader(cache_dir=self.cache.name)
+        # status codes of the chunk requests
+        self.statuses = []
+        get = self.loader.session.get
+        def recording_get(*args, **kwargs):
+            response = get(*args, **kwargs)
+            self.statuses.append(response.status_code)
+            return response
+        self.loader.session.get = recording_get
+
+    def tearDown(self):
+        self.cache.cleanup()
+
+    # unchanged chunks are revalidated and come from the cache, changed ones are downloaded again
+    def test_revalidation(self):
+        self.sim.canvases[0][0:256, 0:256] = 5
+        self.sim.versions[0, 0, 0] = 1
+        first = self.loader.fetch(0, 0, 0)
+        self.assertEqual(self.statuses, [200])
+        self.assertEqual(self.loader.fetch(0, 0, 0), first)
+        self.assertEqual(self.statuses, [200, 304])
+
+        self.sim.canvases[0][0, 0] = 6
+        self.sim.versions[0, 0, 0] = 2
+        changed = self.loader.fetch(0, 0, 0)
+        self.assertEqual(self.statuses, [200, 304, 200])
+        self.assertEqual(ppfun2.decode_chunk(changed)[0, 0], 6)
+        # and the new copy is the one that's cached now
+        self.assertEqual(self.loader.fetch(0, 0, 0), changed)
+        self.assertEqual(self.statuses[-1], 304)
+
+    # if the server can't be reached, the cached copy is better than nothing
+    def test_stale_copy(self):
+        first = self.loader.fetch(0, 1, 1)
+        def unreachable(*args, **kwargs):
+            raise requests.ConnectionError()
+        self.loader.session.get = unreachable
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(self.loader.fetch(0, 1, 1), first)
+            with self.assertRaises(requests.RequestException):
+                self.loader.fetch(0, 2, 2)
+
+    # chunks cached from one server are never used for another one
+    def test_other_server(self):
+        self.sim.canvases[0][0:256, 0:256] = 5
+        self.sim.versions[0, 0, 0] = 1
+        self.loader.fetch(0, 0, 0)
+        other = start_sim(canvas_size=1024)
+        other.versions[0, 0, 0] = 1
+        self.assertEqual(ppfun2.decode_chunk(self.loader.fetch(0, 0, 0))[0, 0], 0)
+        self.assertEqual(self.statuses, [200, 200])
+        # not even if it can't be reached
+        ppfun2.PPFUN_URL = 'http://127.0.0.1:1'
+        self.loader.session.mount('http://', requests.adapters.HTTPAdapter(max_retries=0))
+        with contextlib.redirect_stdout(io.StringIO()):
+            with self.assertRaises(requests.RequestException):
+                self.loader.fetch(0, 0, 0)
+
+    # the old copy of a changed chunk is deleted, the ones still in use are kept
+    def test_prune(self):
+        blobs = lambda: sorted(name for _, _, files in os.walk(os.path.join(self.cache.name, 'blobs')) for name in files)
+        self.sim.canvases[0][0:256, 0:256] = 5
+        self.sim.versions[0, 0, 0] = 1
+        self.loader.fetch(0, 0, 0)
+        self.loader.fetch(0, 1, 0)
+        self.loader.fetch(0, 1, 1)
+        before = blobs()
+        self.sim.canvases[0][0, 0] = 6
+        self.sim.versions[0, 0, 0] = 2
+        changed = self.loader.fetch(0, 0, 0)
+        self.assertEqual(len(blobs()), len(before) + 1)
+        self.loader.prune()
+        self.assertEqual(len(blobs()), len(before))
+        self.assertEqual(self.loader.fetch(0, 0, 0), changed)
+        self.assertEqual(self.statuses[-1], 304)
+
+class ChunkStoreTest(unittest.TestCase):
+    # a sampled region is the same as sampling the whole one, across chunk borders and missing chunks
+    def test_region_step(self):
+        ppfun2.me = {'canvases': {'0': {'size': 4096}}}
+        ppfun2.canvas_geometries.clear()
+        rng = np.random.default_rng(0)
+        store = ppfun2.ChunkStore(0)
+        for c in ((7, 7), (8, 7), (8, 8), (9, 9)):
+            store.tiles[c] = rng.integers(0, 32, (256, 256)).astype(np.uint8)
+        for x, y, w, h in ((-300, -250, 900, 700), (5, 3, 1, 1), (-1, -1, 300, 2), (200, 10, 100, 600)):
+            full = store.region(x, y, w, h, fill=1)
+            for step in (1, 2, 3, 7, 256, 1000):
+                self.assertTrue((store.region(x, y, w, h, fill=1, step=step) == full[::step, ::step]).all())
+
+class MeCacheTest(unittest.TestCase):
+    # a corrupt cached canvas list is requested again instead of crashing the bot
+    def test_corrupt_cache(self):
+        sim = start_sim()
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for content in ('{"url": ', '[]', '{"url": "x"}', 'null'):
+                with open(os.path.join(cache_dir, 'me.json'), 'w') as f:
+                    f.write(content)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    self.assertEqual(ppfun2.get_me(cache_dir), sim.me())
+            # and the fresh copy is cached
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                ppfun2.get_me(cache_dir)
+            self.assertEqual(out.getvalue(), '')
+
+class TemplateTest(unittest.TestCase):
+    # a converted image is cached and loaded back the same
+    def test_cache(self):
+        import cv2
+        img = np.random.default_rng(0).integers(0, 256, (20, 30, 4), np.uint8)
+        with tempfile.TemporaryDirectory() as tmp:
+            img_path = os.path.join(tmp, 'image.png')
+            cv2.imwrite(img_path, img)
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                converted, transparent = ppfun2.load_template(img_path, 0, ppsim.SIM_COLORS, cache_dir=tmp)
+                cached, cached_transparent = ppfun2.load_template(img_path, 0, ppsim.SIM_COLORS, cache_dir=tmp)
+            # the image was only converted once
+            self.assertEqual(out.getvalue().count('Processing the image'), 1)
+            self.assertTrue((converted == ppfun2.quantize_image(img, ppsim.SIM_COLORS)).all())
+            self.assertTrue((cached == converted).all() and (cached_transparent == transparent).all())
+
+class PixelLogTest(unittest.TestCase):
+    # the replayed chunks match what they were at any time, across checkpoints and time marks
+    def test_replay(self):
+        ppfun2.me = {'canvases': {'0': {'size': 4096}, '1': {'size': 1024}}}
+        ppfun2.canvas_geometries.clear()
+        rng = np.random.default_rng(0)
+        stores = {d: ppfun2.ChunkStore(d) for d in (0, 1)}
+        for d, coords in ((0, [(3, 4), (4, 4)]), (1, [(1, 1)])):
+            for c in coords:
+                stores[d].tiles[c] = rng.integers(0, 32, (256, 256)).astype(np.uint8)
+        with tempfile.TemporaryDirectory() as log_dir:
+            recorder = ppfun2.PixelRecorder(log_dir, stores, checkpoint_interval=50)
+            t, history = 1.7e9, []
+            for _ in range(300):
+                # short gaps fit in the records, long ones need time marks
+                t += rng.choice([0.01, 0.5, 3, 80])
+                d = int(rng.integers(0, 2))
+                coords = list(stores[d].tiles)
+                picked = [coords[k] for k in rng.integers(0, len(coords), int(rng.integers(1, 20)))]
+                i, j = (np.array(c, np.uint8) for c in zip(*picked))
+                offs, clr = rng.integers(0, 65536, len(i)), rng.integers(0, 32, len(i)).astype(np.uint8)
+                recorder.record(d, i, j, offs, clr, now=t)
+                xs, ys = ppfun2.canvas_geometry(d).from_packet(i.astype(np.int64), j.astype(np.int64), offs)
+                for x, y, c in zip(xs.tolist(), ys.tolist(), clr.tolist()):
+                    stores[d].set_pixel(x, y, c)
+                history.append((t, {d: {c: tile.copy() for c, tile in store.tiles.items()} for d, store in stores.items()}))
+            recorder.close()
+
+            log = ppfun2.PixelLog(log_dir)
+            self.assertGreater(len(log.checkpoints), 1)
+            self.assertAlmostEqual(log.end, history[-1][0], places=2)
+            for k in rng.integers(0, len(history), 20).tolist():
+                t, expected = history[k]
+                state = log.state_at(t)
+                for d, tiles in expected.items():
+                    for c, tile in tiles.items():
+                        self.assertTrue((state[d].tiles[c] == tile).all())
+
+class ServerTest(unittest.TestCase):
+    def tearDown(self):
+        ppfun2.set_server('https://pixelplanet.fun')
+
+    def test_set_server(self):
+        ppfun2.set_server('http://127.0.0.1:8080/')
+        self.assertEqual((ppfun2.PPFUN_URL, ppfun2.PPFUN_WS_URL), ('http://127.0.0.1:8080', 'ws://127.0.0.1:8080/ws'))
+        ppfun2.set_server('https://pixelplanet.fun')
+        self.assertEqual(ppfun2.PPFUN_WS_URL, 'wss://pixelplanet.fun/ws')
+
+    def test_option(self):
+        self.assertEqual(ppfun2.parse_args(['--server', 'http://localhost:8080'])['server'], 'http://localhost:8080')
+        self.assertNotIn('server', ppfun2.parse_args([]))
+
+class RenderTest(unittest.TestCase):
+    def setUp(self):
+        ppfun2.me = {'canvases': {'0': {'size': 65536, 'colors': ppsim.SIM_COLORS}}}
+        ppfun2.canvas_luts.clear()
+
+    # the part of a template that sticks out of the map on the top or left is cut off
+    def test_overlay_negative_offset(self):
+        data = np.zeros((200, 200), np.uint8)
+        template = np.full((200, 200), 5, np.uint8)
+        for step in (1, 3):
+            img = ppfun2.render_map(0, data, step, template, (-100, -100), alpha=1)
+            expected = ppfun2.render_map(0, data, step, template[100:, 100:], (0, 0), alpha=1)
+            self.assertTrue((img == expected).all())
+            overlaid = (img == ppfun2.canvas_lut(0)[5]).all(axis=2)
+            self.assertEqual(overlaid.sum(), len(range(0, 100, step)) ** 2)
+
+    def test_overlay_positive_offset(self):
+        data = np.zeros((10, 10), np.uint8)
+        img = ppfun2.render_map(0, data, 2, np.full((4, 4), 5, np.uint8), (3, 3), alpha=1)
+        overlaid = (img == ppfun2.canvas_lut(0)[5]).all(axis=2)
+        self.assertEqual(np.argwhere(overlaid).tolist(), [[2, 2], [2, 3], [3, 2], [3, 3]])
+
+class ClientTest(unittest.TestCase):
+    # a late answer to a placement that timed out doesn't count as the answer to the next one
+    def test_late_pixel_return(self):
+        ppfun2.me = {'canvases': {'0': {'size': 65536, 'colors': ppsim.SIM_COLORS}}}
+        ppfun2.canvas_geometries.clear()
+        async def run():
+            client = ppfun2.Client(lambda packet: None)
+            client.PLACE_TIMEOUT = 0.05
+            self.assertIsNone(await client.place(0, 0, 0, 2))
+            second = asyncio.create_task(client.place(0, 1, 0, 2))
+            await asyncio.sleep(0)
+            client._pixel_return(ppfun2.PixelReturn(9, 5000, 1))
+            client._pixel_return(ppfun2.PixelReturn(0, 1000, 1))
+            return await second
+        self.assertEqual(asyncio.run(run()).rc, 0)
+
+class SessionsTest(unittest.TestCase):
+    # more sessions than the default executor has threads must still all place pixels
+    def test_many_sessions(self):
+        sim = start_sim(cooldown_ms=50, stack_ms=300)
+        img = np.random.default_rng(0).integers(2, len(ppsim.SIM_COLORS), (16, 16)).astype(np.uint8)
+        store = ppfun2.ChunkStore(0)
+        store.load(ppfun2.template_chunks(0, img == 255, 0, 0))
+        sessions = min(32, (os.cpu_count() or 1) + 4) + 2
+        # about 0.4 s with every session placing, minutes if they wait for each other
+        run_bot_until(sim, [ppfun2.Job(store, img, 0, 0, False, 'forward')],
+                      lambda: (sim.area(0, 0, 16, 16) == img).all(), 60, sessions)
+
+    # an account that isn't allowed to draw only stops its own session
+    def test_refused_session(self):
+        sim = start_sim(cooldown_ms=50, stack_ms=300)
+        sim.registered_only = True
+        img = np.random.default_rng(0).integers(2, len(ppsim.SIM_COLORS), (8, 8)).astype(np.uint8)
+        store = ppfun2.ChunkStore(0)
+        store.load(ppfun2.template_chunks(0, img == 255, 0, 0))
+        sessions = [([], None, None), (['Cookie: pixelplanet.session=test'], None, None)]
+        with contextlib.redirect_stdout(io.StringIO()):
+            asyncio.run(asyncio.wait_for(ppfun2.run_bot(sessions, [ppfun2.Job(store, img, 0, 0, False, 'forward')]), 30))
+        self.assertEqual(sim.return_codes.get(6), 1)
+        self.assertTrue((sim.area(0, 0, 8, 8) == img).all())
+
+    # but if none of them are, the bot stops
+    def test_all_sessions_refused(self):
+        sim = start_sim()
+        sim.registered_only = True
+        img = np.full((4, 4), 2, np.uint8)
+        store = ppfun2.ChunkStore(0)
+        store.load(ppfun2.template_chunks(0, img == 255, 0, 0))
+        with self.assertRaises(ppfun2.PlacementError):
+            run_bot_against(sim, [ppfun2.Job(store, img, 0, 0, False, 'forward')], 30, 2)
+
+class UpdatesTest(unittest.TestCase):
+    # a pixel that changed several times in a batch is applied once and isn't counted as dropped
+    def test_repeated_changes(self):
+        ppfun2.me = {'canvases': {'0': {'size': 1024, 'colors': ppsim.SIM_COLORS}}}
+        ppfun2.canvas_geometries.clear()
+        img = np.full((4, 4), 2, np.uint8)
+        store = ppfun2.ChunkStore(0)
+        store.tiles[2, 2] = np.zeros((256, 256), np.uint8)
+        manager = ppfun2.JobManager([ppfun2.Job(store, img, 0, 0, False, 'forward')])
+        async def run():
+            updates = ppfun2.UpdateQueue()
+            # the same pixel three times, another one once, and one outside of the loaded chunks
+            for x, y, c in ((1, 1, 3), (1, 1, 4), (1, 1, 5), (2, 1, 3), (400, 400, 3)):
+                updates.put(0, ppfun2.encode_pixels(0, np.array([x]), np.array([y]), np.array([c]))[0])
+            task = asyncio.create_task(ppfun2.apply_updates(updates, manager))
+            await asyncio.sleep(0.05)
+            task.cancel()
+            return updates
+        with contextlib.redirect_stdout(io.StringIO()):
+            updates = asyncio.run(run())
+        self.assertEqual((updates.applied, updates.dropped), (2, 1))
+        self.assertEqual(store.region(1, 1, 2, 1).tolist(), [[5, 3]])
+
+class RepairQueueTest(unittest.TestCase):
+    def setUp(self):
+        ppfun2.me = {'canvases': {'0': {'size': 1024, 'colors': ppsim.SIM_COLORS}}}
+        ppfun2.canvas_geometries.clear()
+
+    def job(self, img, x, priority=0, defend=False):
+        store = ppfun2.ChunkStore(0)
+        store.tiles[2, 2] = np.zeros((256, 256), np.uint8)
+        return ppfun2.Job(store, img, x, 0, defend, 'forward', priority)
+
+    # pixels pushed in several batches, repeated and from the dirty set come out once each,
+    #  by job priority and then by repair priority (in raster order when that's the same)
+    def test_merged_batches(self):
+        rng = np.random.default_rng(0)
+        jobs = [self.job(rng.integers(2, 6, (30, 40)).astype(np.uint8), 100 * n, n) for n in range(2)]
+        manager = ppfun2.JobManager(jobs)
+        dirty = ppfun2.DirtySet()
+        queue = ppfun2.RepairQueue(manager, dirty)
+        pushed = set()
+        for _ in range(5):
+            for job in jobs:
+                xs, ys = rng.integers(0, 40, 200), rng.integers(0, 30, 200)
+                queue.push([(job, xs, ys)])
+                dirty.add_many(job, xs[:20], ys[:20])
+                pushed.update((job, x, y) for x, y in zip(xs.tolist(), ys.tolist()))
+        self.assertEqual(len(queue), len(pushed))
+        taken = list(queue)
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(set(taken), pushed)
+        self.assertEqual(len(taken), len(pushed))
+        key = lambda p: (manager.rank[p[0]], -float(p[0].importance[p[2], p[1]]), p[2], p[1])
+        self.assertEqual(taken, sorted(taken, key=key))
+
+    # a sweep of a heavily damaged image
+    def test_big_sweep(self):
+        store = ppfun2.ChunkStore(0)
+        store.tiles.update({(i, j): np.zeros((256, 256), np.uint8) for i in range(4) for j in range(4)})
+        job = ppfun2.Job(store, np.full((1000, 1000), 3, np.uint8), -500, -500, False, 'forward')
+        manager = ppfun2.JobManager([job])
+        queue = ppfun2.RepairQueue(manager)
+        queue.push(manager.wrong_pixels([job]))
+        self.assertEqual(len(queue), 1000 * 1000)
+        # the outline of the image matters the most
+        self.assertEqual([next(queue)[1:] for _ in range(3)], [(0, 0), (1, 0), (2, 0)])
+
+    # the pixels griefed the most and most recently are repaired first, then damaged outlines,
+    #  and then the rest of the image
+    def test_priority_order(self):
+        # a flat image with a black outline
+        img = np.full((20, 20), 5, np.uint8)
+        img[0, :] = img[-1, :] = img[:, 0] = img[:, -1] = 2
+        job = self.job(img, 0, defend=True)
+        manager = ppfun2.JobManager([job])
+        queue = ppfun2.RepairQueue(manager)
+        now = time.monotonic()
+        # griefed a while ago, a lot just now, and once just now
+        job.heat.hit(np.array([5]), np.array([5]), now - 300)
+        job.heat.hit(np.array([9, 9, 9]), np.array([9, 9, 9]), now)
+        job.heat.hit(np.array([12]), np.array([12]), now)
+        pixels = [(3, 3), (5, 5), (12, 12), (9, 9), (0, 10)]
+        queue.push([(job, np.array([x for x, _ in pixels]), np.array([y for _, y in pixels]))])
+        self.assertEqual([(x, y) for _, x, y in queue], [(9, 9), (12, 12), (0, 10), (5, 5), (3, 3)])
+
+    # the same pixels in raster order
+    def test_raster_order(self):
+        job = self.job(np.full((20, 20), 5, np.uint8), 0, defend=True)
+        job.heat.hit(np.array([9]), np.array([9]))
+        queue = ppfun2.RepairQueue(ppfun2.JobManager([job]))
+        ppfun2.DEFEND_ORDER = 'raster'
+        try:
+            queue.push([(job, np.array([3, 9, 12, 0]), np.array([3, 9, 3, 10]))])
+        finally:
+            ppfun2.DEFEND_ORDER = 'priority'
+        self.assertEqual([(x, y) for _, x, y in queue], [(3, 3), (12, 3), (9, 9), (0, 10)])
+
+class HeatMapTest(unittest.TestCase):
+    def test_value(self):
+        heat = ppfun2.HeatMap((4, 4), half_life=10)
+        t = heat.start
+        heat.hit(np.array([1, 1, 2]), np.array([0, 0, 3]), t)
+        xs, ys = np.array([1, 2, 3]), np.array([0, 3, 3])
+        self.assertTrue(np.allclose(heat.value(xs, ys, t), [2, 1, 0]))
+        # halves every half life
+        self.assertTrue(np.allclose(heat.value(xs, ys, t + 10), [1, 0.5, 0]))
+        heat.hit(np.array([2]), np.array([3]), t + 20)
+        self.assertTrue(np.allclose(heat.value(xs, ys, t + 20), [0.5, 1.25, 0]))
+
+    # rescaling the array when the weight gets too big doesn't change the values
+    def test_rescale(self):
+        heat = ppfun2.HeatMap((2, 2), half_life=1)
+        t = heat.start
+        heat.hit(np.array([0]), np.array([0]), t)
+        heat.hit(np.array([1]), np.array([1]), t + 200)
+        heat.hit(np.array([1]), np.array([1]), t + 201)
+        self.assertTrue(np.allclose(heat.value(np.array([0, 1]), np.array([0, 1]), t + 202), [0, 0.75]))
+
+    def test_recency(self):
+        heat = ppfun2.HeatMap((2, 2))
+        t = heat.start + 1
+        heat.hit(np.array([0]), np.array([0]), t)
+        xs, ys = np.array([0, 1]), np.array([0, 1])
+        self.assertTrue(np.allclose(heat.recency(xs, ys, t), [1, 0]))
+        self.assertTrue(np.allclose(heat.recency(xs, ys, t + ppfun2.RECENCY_TIME), [math.exp(-1), 0]))
+
+class MetricsTest(unittest.TestCase):
+    # the wrong pixel count is exported when the metrics are served too, not only written to a file
+    def test_wrong_pixels_served(self):
+        sim = start_sim(cooldown_ms=1000, stack_ms=1000)
+        img = np.full((4, 4), 2, np.uint8)
+        store = ppfun2.ChunkStore(0)
+        store.load(ppfun2.template_chunks(0, img == 255, 0, 0))
+        with contextlib.redirect_stdout(io.StringIO()):
+            try:
+                asyncio.run(asyncio.wait_for(ppfun2.run_bot([([], None, None)], [ppfun2.Job(store, img, 0, 0, False, 'forward')], 0), 0.5))
+            except asyncio.TimeoutError:
+                pass
+        wrong = [line for line in ppfun2.metrics.render().splitlines() if line.startswith('ppfun2_wrong_pixels ')]
+        self.assertIn(wrong, [['ppfun2_wrong_pixels 16'], ['ppfun2_wrong_pixels 15']])
+
+class DefendTest(unittest.TestCase):
+    # one session defending images on two canvases has to notice griefing on both of them,
+    #  not only on the one it selected last
+    def test_griefing_on_two_canvases(self):
+        rng = np.random.default_rng(0)
+        templates = [(d, 8 * d, 0, rng.integers(2, len(ppsim.SIM_COLORS), (8, 8)).astype(np.uint8)) for d in range(2)]
+        sim = start_sim(canvas_size=1024, cooldown_ms=10, stack_ms=200, canvases=2)
+        jobs = []
+        for n, (d, x, y, img) in enumerate(templates):
+            store = ppfun2.ChunkStore(d)
+            store.load(ppfun2.template_chunks(d, img == 255, x, y))
+            # the one on canvas 0 is more important, so it is drawn first and the session ends up on canvas 1
+            jobs.append(ppfun2.Job(store, img, x, y, True, 'forward', 1 - n))
+        drawn = lambda: all((sim.area(x, y, 8, 8, d) == img).all() for d, x, y, img in templates)
+        # grief every template pixel once the images are drawn, and wait for them to be repaired
+        griefed = False
+        def repaired():
+            nonlocal griefed
+            if not griefed:
+                if drawn():
+                    sim.loop.call_soon_threadsafe(lambda: [sim._grief(d, x + n % 8, y + n // 8, 2 if img[n // 8, n % 8] != 2 else 3)
+                                                           for d, x, y, img in templates for n in range(64)])
+                    griefed = True
+                return False
+            return sim.griefed == 128 and drawn()
+        run_bot_until(sim, jobs, repaired)
+
+if __name__ == "__main__":
+    unittest.main()